@@ -14,6 +14,8 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import binascii
+import struct
 from collections import namedtuple
 
 try:
@@ -32,10 +34,14 @@ try:
     if sizeof_ptr == 4:
         def fmt_addr(addr):
             return '0x%08x' % addr
+        # For decoding pointers from raw bytes of the inferior's memory
+        # (assuming the inferior has the same byte order as gdb's host):
+        ptr_struct = struct.Struct('=I')
     else:
         # Assume 64-bit:
         def fmt_addr(addr):
             return '0x%016x' % addr
+        ptr_struct = struct.Struct('=Q')
 
 except ImportError:
     # Support importing heap.parser from outside gdb
@@ -75,11 +81,16 @@ def array_length(_gdbval):
     the array'''
     arr_size = _gdbval.type.sizeof
     elem_size = _gdbval[0].type.sizeof
-    return arr_size/elem_size
+    return arr_size // elem_size
+
+__offsetof_cache = {}
 
 def offsetof(typename, fieldname):
     '''Get the offset (in bytes) from the start of the given type to the given
     field'''
+    key = (typename, fieldname)
+    if key in __offsetof_cache:
+        return __offsetof_cache[key]
 
     # This is a transliteration to gdb's python API of:
     #    (int)(void*)&((#typename*)NULL)->#fieldname)
@@ -88,7 +99,31 @@ def offsetof(typename, fieldname):
     v = gdb.Value(0)
     v = v.cast(t)
     field = v[fieldname].cast(type_void_ptr)
-    return int(field.address)
+    result = __offsetof_cache[key] = int(field.address)
+    return result
+
+__field_struct_cache = {}
+
+def field_struct(typename, fieldname):
+    '''Get an (offset, struct.Struct) pair, for decoding the given integer or
+    pointer field of the given type from a buffer of the inferior's memory
+    (see read_memory), rather than accessing it via gdb.Value'''
+    key = (typename, fieldname)
+    if key in __field_struct_cache:
+        return __field_struct_cache[key]
+
+    # (going via a gdb.Value, so that fields within anonymous unions work):
+    t = caching_lookup_type(typename).pointer()
+    fieldtype = gdb.Value(0).cast(t)[fieldname].type.strip_typedefs()
+    code = {1:'B', 2:'H', 4:'I', 8:'Q'}[fieldtype.sizeof]
+    if (fieldtype.code == gdb.TYPE_CODE_INT
+        and not str(fieldtype).startswith('unsigned')):
+        code = code.lower()
+    # (assuming the inferior has the same byte order as gdb's host, as for
+    # ptr_struct):
+    result = (offsetof(typename, fieldname), struct.Struct('=' + code))
+    __field_struct_cache[key] = result
+    return result
 
 class MissingDebuginfo(RuntimeError):
     def __init__(self, module):
@@ -106,6 +141,10 @@ class WrappedValue(object):
     Base class, wrapping an underlying gdb.Value adding various useful methods,
     and allowing subclassing
     """
+    # There can be very many of these, so avoid a per-instance __dict__ (for
+    # subclasses that also define __slots__):
+    __slots__ = ('_gdbval',)
+
     def __init__(self, gdbval):
         self._gdbval = gdbval
 
@@ -150,8 +189,12 @@ class WrappedValue(object):
         return int(self._gdbval) == 0
 
 class WrappedPointer(WrappedValue):
+    __slots__ = ()
+
     def as_address(self):
-        return int(self._gdbval.cast(type_void_ptr))
+        # int() of a pointer gdb.Value is already its address; there's no
+        # need to round-trip through a (void*) cast:
+        return int(self._gdbval)
 
     def __str__(self):
         return ('<%s for inferior 0x%x>'
@@ -190,6 +233,10 @@ def as_hexdump_char(b):
     else:
         return '.'
 
+# bytes.translate table mapping each byte to its as_hexdump_char equivalent:
+_HEXDUMP_CHAR_TABLE = bytes(bytearray([b if 0x20 <= b < 0x80 else ord('.')
+                                       for b in range(256)]))
+
 def sign(amt):
     if amt >= 0:
         return '+'
@@ -214,6 +261,7 @@ class Category(namedtuple('Category', ('domain', 'kind', 'detail'))):
 
       detail: additional detail
     '''
+    __slots__ = ()
 
     def __new__(_cls, domain, kind, detail=None):
         return tuple.__new__(_cls, (domain, kind, detail))
@@ -223,7 +271,8 @@ class Category(namedtuple('Category', ('domain', 'kind', 'detail'))):
 
 class Usage(object):
     # Information about an in-use area of memory
-    slots = ('start', 'size', 'category', 'level', 'hd', 'obj')
+    # (there's one of these per block of the heap, so avoid a __dict__):
+    __slots__ = ('start', 'size', 'category', 'level', 'hd', 'obj')
 
     def __init__(self, start, size, category=None, level=None, hd=None, obj=None):
         assert isinstance(start, int)
@@ -256,18 +305,61 @@ class Usage(object):
             self.hd = hexdump_as_bytes(self.start, NUM_HEXDUMP_BYTES)
 
 
+def read_memory(addr, size):
+    '''Read size bytes of the inferior's memory, starting at addr, in a single
+    call, returning them as a bytes instance'''
+    return bytes(gdb.selected_inferior().read_memory(addr, size))
+
+# Upper limit on the size of a single read of the inferior's memory:
+MAX_READ_RUN = 0x10000
+
+def read_memory_regions(regions):
+    '''Given a sequence of (addr, size) pairs in ascending order of address,
+    yield the bytes of each of those regions of the inferior's memory in turn
+    (or None for any that couldn't be read).
+
+    Rather than reading the inferior's memory once per region, read it once
+    for each run of regions spanning up to MAX_READ_RUN bytes'''
+    run = []
+    for addr, size in regions:
+        if run and addr + size - run[0][0] > MAX_READ_RUN:
+            for buf in _read_memory_run(run):
+                yield buf
+            run = []
+        run.append((addr, size))
+    for buf in _read_memory_run(run):
+        yield buf
+
+def _read_memory_run(run):
+    if not run:
+        return
+    start = min([addr for addr, size in run])
+    end = max([addr + size for addr, size in run])
+    try:
+        buf = read_memory(start, end - start)
+    except RuntimeError:
+        # Part of the run couldn't be read (e.g. missing from a core file);
+        # fall back to reading each region individually:
+        for addr, size in run:
+            try:
+                yield read_memory(addr, size)
+            except RuntimeError:
+                yield None
+        return
+    for addr, size in run:
+        yield buf[addr - start:addr - start + size]
+
 def hexdump_as_bytes(addr, size, chars_only=True):
-    addr = gdb.Value(addr).cast(type_unsigned_char_ptr)
-    bytebuf = []
-    for j in range(size):
-        ptr = addr + j
-        b = int(ptr.dereference())
-        bytebuf.append(b)
+    return hexdump_from_bytes(read_memory(addr, size), chars_only)
 
+def hexdump_from_bytes(bytebuf, chars_only=True):
+    '''Format a hexdump of memory that has already been read from the
+    inferior'''
     result = ''
     if not chars_only:
-        result += ' '.join(['%02x' % b for b in bytebuf]) + ' |'
-    result += ''.join([as_hexdump_char(b) for b in bytebuf])
+        hexstr = binascii.hexlify(bytebuf).decode('ascii')
+        result += ' '.join([hexstr[i:i+2] for i in range(0, len(hexstr), 2)]) + ' |'
+    result += bytebuf.translate(_HEXDUMP_CHAR_TABLE).decode('ascii')
     result += '|'
 
     return (result)
@@ -296,13 +388,22 @@ class Table(object):
         self.columnheadings = columnheadings
         self.rows = []
         self._colsep = '  '
+        # Running maximum width of each column, updated as rows are added:
+        self._colwidths = [len(heading) for heading in columnheadings]
 
     def add_row(self, row):
         assert len(row) == self.numcolumns
+        # Stringify each cell once, here, rather than when computing the
+        # column widths and again when writing:
+        row = tuple([str(cell) for cell in row])
+        colwidths = self._colwidths
+        for i, cell in enumerate(row):
+            if len(cell) > colwidths[i]:
+                colwidths[i] = len(cell)
         self.rows.append(row)
 
     def write(self, out):
-        colwidths = self._calc_col_widths()
+        colwidths = self._colwidths
 
         self._write_row(out, colwidths, self.columnheadings)
 
@@ -311,17 +412,6 @@ class Table(object):
         for row in self.rows:
             self._write_row(out, colwidths, row)
 
-    def _calc_col_widths(self):
-        result = []
-        for colIndex in range(self.numcolumns):
-            result.append(self._calc_col_width(colIndex))
-        return result
-
-    def _calc_col_width(self, idx):
-        cells = [str(row[idx]) for row in self.rows]
-        heading = self.columnheadings[idx]
-        return max([len(c) for c in (cells + [heading])])
-
     def _write_row(self, out, colwidths, values):
         for i, (value, width) in enumerate(zip(values, colwidths)):
             if i > 0:
@@ -340,9 +430,15 @@ class Table(object):
 class UsageSet(object):
     def __init__(self, usage_list):
         self.usage_list = usage_list
+        self._usage_by_address = None
 
-        # Ensure we can do fast lookups:
-        self.usage_by_address = dict([(int(u.start), u) for u in usage_list])
+    @property
+    def usage_by_address(self):
+        # Ensure we can do fast lookups, building the index on first use
+        # (there may not be any cross-references to record):
+        if self._usage_by_address is None:
+            self._usage_by_address = {int(u.start): u for u in self.usage_list}
+        return self._usage_by_address
 
     def set_addr_category(self, addr, category, level=0, visited=None, debug=False):
         '''Attempt to mark the given address as being of the given category,
@@ -388,6 +484,15 @@ class PythonCategorizer(object):
         self._type_PyCodeObject_ptr = caching_lookup_type('PyCodeObject').pointer()
         self._type_PyGC_Head = caching_lookup_type('PyGC_Head')
 
+        # Handlers for buffers owned by python objects, by python type name:
+        self._handlers = {'list': self._categorize_list,
+                          'set': self._categorize_set,
+                          'code': self._categorize_code,
+                          'sqlite3.Statement': self._categorize_sqlite3_statement,
+                          'rpm.hdr': self._categorize_rpm_hdr,
+                          'rpm.mi': self._categorize_rpm_mi,
+                          }
+
     @classmethod
     def make(cls):
         '''Try to make a PythonCategorizer, if debuginfo is available; otherwise return None'''
@@ -406,73 +511,105 @@ class PythonCategorizer(object):
             if u.obj.categorize_refs(usage_set):
                 return True
 
-        if c.kind == 'list':
-            list_ptr = gdb.Value(u.start + self._type_PyGC_Head.sizeof).cast(self._type_PyListObject_ptr)
-            ob_item = int(list_ptr['ob_item'])
-            usage_set.set_addr_category(ob_item,
-                                        Category('cpython', 'PyListObject ob_item table', None))
-            return True
+        handler = self._handlers.get(c.kind)
+        if handler:
+            return handler(u, usage_set)
 
-        elif c.kind == 'set':
-            set_ptr = gdb.Value(u.start + self._type_PyGC_Head.sizeof).cast(self._type_PySetObject_ptr)
-            table = int(set_ptr['table'])
-            usage_set.set_addr_category(table,
-                                        Category('cpython', 'PySetObject setentry table', None))
-            return True
+        # Not categorized:
+        return False
 
-        if c.kind == 'code':
-            # Python 2.6's PyCode_Type doesn't have Py_TPFLAGS_HAVE_GC:
-            code_ptr = gdb.Value(u.start).cast(self._type_PyCodeObject_ptr)
-            co_code =  int(code_ptr['co_code'])
-            usage_set.set_addr_category(co_code,
-                                        Category('python', 'str', 'bytecode'), # FIXME: on py3k this should be bytes
-                                        level=1)
-            return True
-        elif c.kind == 'sqlite3.Statement':
-            ptr_type = caching_lookup_type('pysqlite_Statement').pointer()
-            obj_ptr = gdb.Value(u.start).cast(ptr_type)
-            #print obj_ptr.dereference()
-            from heap.sqlite import categorize_sqlite3
-            for fieldname, catname, fn in (('db', 'sqlite3', categorize_sqlite3),
-                                           ('st', 'sqlite3_stmt', None)):
-                field_ptr = int(obj_ptr[fieldname])
-
-                # sqlite's src/mem1.c adds a a sqlite3_int64 (size) to the front
-                # of the allocation, so we need to look 8 bytes earlier to find
-                # the malloc-ed region:
-                malloc_ptr = field_ptr - 8
-
-                # print u, fieldname, category, field_ptr
-                if usage_set.set_addr_category(malloc_ptr, Category('sqlite3', catname)):
-                    if fn:
-                        fn(field_ptr, usage_set, set())
-            return True
+    def _categorize_list(self, u, usage_set):
+        list_ptr = gdb.Value(u.start + self._type_PyGC_Head.sizeof).cast(self._type_PyListObject_ptr)
+        ob_item = int(list_ptr['ob_item'])
+        usage_set.set_addr_category(ob_item,
+                                    Category('cpython', 'PyListObject ob_item table', None))
+        return True
 
-        elif c.kind == 'rpm.hdr':
-            ptr_type = caching_lookup_type('struct hdrObject_s').pointer()
-            if ptr_type:
-                obj_ptr = gdb.Value(u.start).cast(ptr_type)
-                # print obj_ptr.dereference()
-                h = obj_ptr['h']
-                if usage_set.set_addr_category(int(h), Category('rpm', 'Header', None)):
-                    blob = h['blob']
-                    usage_set.set_addr_category(int(blob), Category('rpm', 'Header blob', None))
-
-        elif c.kind == 'rpm.mi':
-            ptr_type = caching_lookup_type('struct rpmmiObject_s').pointer()
-            if ptr_type:
-                obj_ptr = gdb.Value(u.start).cast(ptr_type)
-                print(obj_ptr.dereference())
-                mi = obj_ptr['mi']
-                if usage_set.set_addr_category(int(mi),
-                                               Category('rpm', 'rpmdbMatchIterator', None)):
-                    pass
-                    #blob = h['blob']
-                    #usage_set.set_addr_category(int(blob), 'rpm Header blob')
+    def _categorize_set(self, u, usage_set):
+        set_ptr = gdb.Value(u.start + self._type_PyGC_Head.sizeof).cast(self._type_PySetObject_ptr)
+        table = int(set_ptr['table'])
+        usage_set.set_addr_category(table,
+                                    Category('cpython', 'PySetObject setentry table', None))
+        return True
 
-        # Not categorized:
+    def _categorize_code(self, u, usage_set):
+        # Python 2.6's PyCode_Type doesn't have Py_TPFLAGS_HAVE_GC:
+        code_ptr = gdb.Value(u.start).cast(self._type_PyCodeObject_ptr)
+        co_code =  int(code_ptr['co_code'])
+        usage_set.set_addr_category(co_code,
+                                    Category('python', 'str', 'bytecode'), # FIXME: on py3k this should be bytes
+                                    level=1)
+        return True
+
+    def _categorize_sqlite3_statement(self, u, usage_set):
+        ptr_type = caching_lookup_type('pysqlite_Statement').pointer()
+        obj_ptr = gdb.Value(u.start).cast(ptr_type)
+        #print obj_ptr.dereference()
+        from heap.sqlite import categorize_sqlite3
+        for fieldname, catname, fn in (('db', 'sqlite3', categorize_sqlite3),
+                                       ('st', 'sqlite3_stmt', None)):
+            field_ptr = int(obj_ptr[fieldname])
+
+            # sqlite's src/mem1.c adds a a sqlite3_int64 (size) to the front
+            # of the allocation, so we need to look 8 bytes earlier to find
+            # the malloc-ed region:
+            malloc_ptr = field_ptr - 8
+
+            # print u, fieldname, category, field_ptr
+            if usage_set.set_addr_category(malloc_ptr, Category('sqlite3', catname)):
+                if fn:
+                    fn(field_ptr, usage_set, set())
+        return True
+
+    def _categorize_rpm_hdr(self, u, usage_set):
+        ptr_type = caching_lookup_type('struct hdrObject_s').pointer()
+        if ptr_type:
+            obj_ptr = gdb.Value(u.start).cast(ptr_type)
+            # print obj_ptr.dereference()
+            h = obj_ptr['h']
+            if usage_set.set_addr_category(int(h), Category('rpm', 'Header', None)):
+                blob = h['blob']
+                usage_set.set_addr_category(int(blob), Category('rpm', 'Header blob', None))
         return False
 
+    def _categorize_rpm_mi(self, u, usage_set):
+        ptr_type = caching_lookup_type('struct rpmmiObject_s').pointer()
+        if ptr_type:
+            obj_ptr = gdb.Value(u.start).cast(ptr_type)
+            print(obj_ptr.dereference())
+            mi = obj_ptr['mi']
+            if usage_set.set_addr_category(int(mi),
+                                           Category('rpm', 'rpmdbMatchIterator', None)):
+                pass
+                #blob = h['blob']
+                #usage_set.set_addr_category(int(blob), 'rpm Header blob')
+        return False
+
+__cache_flush_hooks = []
+
+def on_cache_flush(fn):
+    '''Register a function (taking no arguments) to be called whenever
+    flush_caches() is'''
+    __cache_flush_hooks.append(fn)
+
+def flush_caches(event=None):
+    '''Discard everything memoized about the inferior and its debuginfo.
+
+    This is wired up to gdb's "new_objfile" and "exited" events: loading
+    a new DSO can make previously-missing types available, and a different
+    executable can give existing names different layouts.  Any other
+    module-level memoization should register itself via on_cache_flush()
+    so that it's discarded at the same points.'''
+    global __cached_usage_list
+    global __cached_reg_state
+    __type_cache.clear()
+    __offsetof_cache.clear()
+    __field_struct_cache.clear()
+    __cached_usage_list = None
+    __cached_reg_state = None
+    for fn in __cache_flush_hooks:
+        fn()
+
 def _get_register_state():
     from heap.compat import execute
     return execute('thread apply all info registers')
@@ -508,6 +645,18 @@ def lazily_get_usage_list():
 
     return __cached_usage_list
 
+#  Disable for now, see https://bugzilla.redhat.com/show_bug.cgi?id=620930
+CPLUSPLUS_DETECTION = False
+
+def use_cplusplus_detection():
+    # C++ detection: only enabled if we can capture "execute"; there seems to
+    # be a bad interaction between pagination and redirection: all output from
+    # "heap" disappears in the fallback form of execute, unless we "set pagination off"
+    if not CPLUSPLUS_DETECTION:
+        return False
+    from heap.compat import has_gdb_execute_to_string
+    return has_gdb_execute_to_string
+
 def categorize_usage_list(usage_list):
     '''Do a "full-graph" categorization of the given list of Usage instances
     For example, if p is a (PyDictObject*), then mark p->ma_table and p->ma_mask
@@ -519,6 +668,11 @@ def categorize_usage_list(usage_list):
     # Precompute some types, if available:
     pycategorizer = PythonCategorizer.make()
 
+    if use_cplusplus_detection():
+        # Resolve all of the candidate vtables in one batch:
+        from heap.cplusplus import prefetch_class_names
+        prefetch_class_names(usage_list)
+
     for u in ProgressNotifier(iter(usage_list), 'Blocks analyzed'):
         # Cover the simple cases, where the category can be figured out directly:
         u.ensure_category(usage_set)
@@ -543,7 +697,7 @@ def categorize(u, usage_set):
     categorizations'''
     from heap.cpython import as_python_object, obj_addr_to_gc_addr
     addr, size = u.start, u.size
-    pyop = as_python_object(addr)
+    pyop = as_python_object(addr, size)
     if pyop:
         u.obj = pyop
         try:
@@ -560,12 +714,8 @@ def categorize(u, usage_set):
     if cat:
         return cat
 
-    # C++ detection: only enabled if we can capture "execute"; there seems to
-    # be a bad interaction between pagination and redirection: all output from
-    # "heap" disappears in the fallback form of execute, unless we "set pagination off"
-    from heap.compat import has_gdb_execute_to_string
-    #  Disable for now, see https://bugzilla.redhat.com/show_bug.cgi?id=620930
-    if False: # has_gdb_execute_to_string:
+    # C++ detection:
+    if use_cplusplus_detection():
         from heap.cplusplus import get_class_name
         cpp_cls = get_class_name(addr, size)
         if cpp_cls:
@@ -583,6 +733,9 @@ def categorize(u, usage_set):
         return Category('C', 'string data')
 
     # Uncategorized:
+    return uncategorized(size)
+
+def uncategorized(size):
     return Category('uncategorized', '', '%s bytes' % size)
 
 def as_nul_terminated_string(addr, size):
@@ -661,9 +814,15 @@ def iter_usage():
     except WrongInferiorProcess:
         pass
 
-    for i, chunk in enumerate(ms.iter_mmap_chunks()):
-        mem_ptr = chunk.as_mem()
-        chunksize = chunk.chunksize()
+    # Work with plain integers here, rather than wrapping every chunk in a
+    # MChunkPtr:
+    from heap.glibc import get_SIZE_SZ
+    mem_offset = 2 * get_SIZE_SZ()
+    for addr, chunksize, inuse in ms.iter_chunk_tuples():
+        if not inuse:
+            continue
+        # Analog of chunk2mem:
+        mem_ptr = addr + mem_offset
 
         arena = cached_state.detect_arena(mem_ptr, chunksize)
         if arena:
@@ -672,18 +831,6 @@ def iter_usage():
         else:
             yield Usage(int(mem_ptr), chunksize)
 
-    for chunk in ms.iter_sbrk_chunks():
-        mem_ptr = chunk.as_mem()
-        chunksize = chunk.chunksize()
-
-        if chunk.is_inuse():
-            arena = cached_state.detect_arena(mem_ptr, chunksize)
-            if arena:
-                for u in arena.iter_usage():
-                    yield u
-            else:
-                yield Usage(int(mem_ptr), chunksize)
-
 
 
 def looks_like_ptr(value):
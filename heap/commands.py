@@ -15,18 +15,20 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import gdb
-import re
 import sys
+from collections import Counter, defaultdict
 
-from heap.glibc import glibc_arenas
-from heap.history import history, Snapshot, Diff
+# heap.glibc and heap.history are imported within the commands that need
+# them, so that loading the extension doesn't pay for them (heap.glibc also
+# looks up the inferior's arenas as soon as it's imported)
 
 from heap import lazily_get_usage_list, \
     fmt_size, fmt_addr, \
-    categorize, categorize_usage_list, Usage, \
-    hexdump_as_bytes, \
+    categorize, uncategorized, Usage, \
+    hexdump_as_bytes, hexdump_from_bytes, read_memory_regions, \
     Table, \
-    MissingDebuginfo
+    MissingDebuginfo, \
+    flush_caches, on_cache_flush
 
 def need_debuginfo(f):
     def g(self, args, from_tty):
@@ -38,6 +40,39 @@ def need_debuginfo(f):
             print('    debuginfo-install %s' % e.module)
     return g
 
+# Walking the chunks of an arena is expensive, so the walk is shared between
+# commands, keyed by (inferior PID, arena address).  The inferior can't have
+# touched its heap until it resumes, so the cache is flushed whenever it does,
+# as well as along with the other caches:
+_chunk_cache = {}
+
+def _flush_chunk_cache(event=None):
+    _chunk_cache.clear()
+
+on_cache_flush(_flush_chunk_cache)
+
+def get_chunks():
+    '''Get a list of all MChunkPtr in the currently selected arena (both used
+    and free), reusing the result of an earlier walk where possible'''
+    from heap.glibc import glibc_arenas
+    ms = glibc_arenas.get_ms()
+    key = (gdb.selected_inferior().pid, int(ms.address))
+    if key not in _chunk_cache:
+        _chunk_cache[key] = list(ms.iter_chunks())
+    return _chunk_cache[key]
+
+def iter_chunk_prefixes(chunks, nbytes):
+    '''Given a list of MChunkPtr in ascending address order, yield a sequence
+    of (chunk, bytes) pairs, where the bytes are the first nbytes of the chunk's
+    memory (as seen by the user of malloc), or empty if it couldn't be read.
+
+    The reads are batched by read_memory_regions, rather than reading the
+    inferior's memory once per chunk'''
+    regions = read_memory_regions([(chunk.as_mem(), nbytes)
+                                   for chunk in chunks])
+    for chunk, membytes in zip(chunks, regions):
+        yield (chunk, membytes if membytes is not None else b'')
+
 class Heap(gdb.Command):
     'Print a report on memory usage, by category'
     def __init__(self):
@@ -48,32 +83,36 @@ class Heap(gdb.Command):
 
     @need_debuginfo
     def invoke(self, args, from_tty):
-        total_by_category = {}
-        count_by_category = {}
+        total_by_category = defaultdict(int)
+        count_by_category = defaultdict(int)
+        # Uncategorized blocks get a category per size; tally them by size,
+        # and only build those categories once all blocks have been seen:
+        uncategorized_by_size = Counter()
         total_size = 0
         total_count = 0
         try:
+            # lazily_get_usage_list() has already categorized every usage:
             usage_list = list(lazily_get_usage_list())
             for u in usage_list:
-                u.ensure_category()
                 total_size += u.size
-                if u.category in total_by_category:
-                    total_by_category[u.category] += u.size
-                else:
-                    total_by_category[u.category] = u.size
-
                 total_count += 1
-                if u.category in count_by_category:
-                    count_by_category[u.category] += 1
-                else:
-                    count_by_category[u.category] = 1
+                if u.category.domain == 'uncategorized':
+                    uncategorized_by_size[u.size] += 1
+                    continue
+                total_by_category[u.category] += u.size
+                count_by_category[u.category] += 1
 
         except KeyboardInterrupt:
             pass # FIXME
 
+        for size, count in uncategorized_by_size.items():
+            category = uncategorized(size)
+            total_by_category[category] += count * size
+            count_by_category[category] += count
+
         t = Table(['Domain', 'Kind', 'Detail', 'Count', 'Allocated size'])
-        for category in sorted(total_by_category.keys(),
-                               key=total_by_category.get,
+        for category in sorted(total_by_category,
+                               key=total_by_category.__getitem__,
                                reverse=True):
             detail = category.detail
             if not detail:
@@ -96,30 +135,27 @@ class HeapSizes(gdb.Command):
                               gdb.COMMAND_DATA)
     @need_debuginfo
     def invoke(self, args, from_tty):
-        ms = glibc_arenas.get_ms()
-        chunks_by_size = {}
-        num_chunks = 0
-        total_size = 0
+        from heap.glibc import MChunkPtr
+        chunks_by_size = Counter()
         try:
-            for chunk in ms.iter_chunks():
-                if not chunk.is_inuse():
-                    continue
-                size = int(chunk.chunksize())
-                num_chunks += 1
-                total_size += size
-                if size in chunks_by_size:
-                    chunks_by_size[size] += 1
-                else:
-                    chunks_by_size[size] = 1
+            # Counter.update() tallies an iterable in C; if interrupted, the
+            # counts gathered so far are kept:
+            chunks_by_size.update(int(chunk.chunksize())
+                                  for chunk in filter(MChunkPtr.is_inuse,
+                                                      get_chunks()))
         except KeyboardInterrupt:
             pass # FIXME
+        num_chunks = sum(chunks_by_size.values())
+        allocated_by_size = dict([(size, count * size)
+                                  for size, count in chunks_by_size.items()])
+        total_size = sum(allocated_by_size.values())
         t = Table(['Chunk size', 'Num chunks', 'Allocated size'])
-        for size in sorted(chunks_by_size.keys(),
-                           key=lambda s1: chunks_by_size[s1] * s1,
+        for size in sorted(allocated_by_size,
+                           key=allocated_by_size.__getitem__,
                            reverse=True):
             t.add_row([fmt_size(size),
                        chunks_by_size[size],
-                       fmt_size(chunks_by_size[size] * size)])
+                       fmt_size(allocated_by_size[size])])
         t.add_row(['TOTALS', num_chunks, fmt_size(total_size)])
         t.write(sys.stdout)
         print()
@@ -134,23 +170,26 @@ class HeapUsed(gdb.Command):
 
     @need_debuginfo
     def invoke(self, args, from_tty):
-        print('Used chunks of memory on heap')
-        print('-----------------------------')
-        ms = glibc_arenas.get_ms()
-        for i, chunk in enumerate(ms.iter_chunks()):
+        lines = ['Used chunks of memory on heap',
+                 '-----------------------------']
+        fmt = '%6i: %s -> %s %8i bytes %20s |%s'
+        # Local aliases for the per-chunk loop:
+        _fmt_addr, _categorize, _hexdump = \
+            fmt_addr, categorize, hexdump_from_bytes
+        append = lines.append
+        for i, (chunk, membytes) in enumerate(iter_chunk_prefixes(get_chunks(), 32)):
             if not chunk.is_inuse():
                 continue
             size = chunk.chunksize()
             mem = chunk.as_mem()
             u = Usage(mem, size)
-            category = categorize(u, None)
-            hd = hexdump_as_bytes(mem, 32)
-            print ('%6i: %s -> %s %8i bytes %20s |%s'
-                   % (i,
-                      fmt_addr(chunk.as_mem()),
-                      fmt_addr(chunk.as_mem()+size-1),
-                      size, category, hd))
-        print()
+            category = _categorize(u, None)
+            hd = _hexdump(membytes)
+            append(fmt % (i, _fmt_addr(mem), _fmt_addr(mem + size - 1),
+                          size, category, hd))
+        # Emit everything in one write, rather than a print per chunk:
+        lines.append('\n')
+        sys.stdout.write('\n'.join(lines))
 
 class HeapFree(gdb.Command):
     'Print free heap chunks'
@@ -163,6 +202,7 @@ class HeapFree(gdb.Command):
     def invoke(self, args, from_tty):
         print('Free chunks of memory on heap')
         print('-----------------------------')
+        from heap.glibc import glibc_arenas
         ms = glibc_arenas.get_ms()
         total_size = 0
 
@@ -175,9 +215,7 @@ class HeapFree(gdb.Command):
             hd = hexdump_as_bytes(mem, 32)
 
             print ('%6i: %s -> %s %8i bytes %20s |%s'
-                   % (i,
-                      fmt_addr(chunk.as_mem()),
-                      fmt_addr(chunk.as_mem()+size-1),
+                   % (i, fmt_addr(mem), fmt_addr(mem + size - 1),
                       size, category, hd))
 
         print("Total size: %s" % total_size)
@@ -192,22 +230,24 @@ class HeapAll(gdb.Command):
 
     @need_debuginfo
     def invoke(self, args, from_tty):
-        print('All chunks of memory on heap (both used and free)')
-        print('-------------------------------------------------')
-        ms = glibc_arenas.get_ms()
-        for i, chunk in enumerate(ms.iter_chunks()):
+        lines = ['All chunks of memory on heap (both used and free)',
+                 '-------------------------------------------------']
+        fmt = '%i: %s -> %s %s: %i bytes (%s)'
+        # Local aliases for the per-chunk loop:
+        _fmt_addr = fmt_addr
+        append = lines.append
+        for i, chunk in enumerate(get_chunks()):
             size = chunk.chunksize()
+            addr = chunk.as_address()
             if chunk.is_inuse():
                 kind = ' inuse'
             else:
                 kind = ' free'
 
-            print ('%i: %s -> %s %s: %i bytes (%s)'
-                   % (i,
-                      fmt_addr(chunk.as_address()),
-                      fmt_addr(chunk.as_address()+size-1),
-                      kind, size, chunk))
-        print()
+            append(fmt % (i, _fmt_addr(addr), _fmt_addr(addr + size - 1),
+                          kind, size, chunk))
+        lines.append('\n')
+        sys.stdout.write('\n'.join(lines))
 
 class HeapLog(gdb.Command):
     'Print a log of recorded heap states'
@@ -218,17 +258,19 @@ class HeapLog(gdb.Command):
 
     @need_debuginfo
     def invoke(self, args, from_tty):
+        from heap.history import history
         h = history
         if len(h.snapshots) == 0:
             print('(no history)')
             return
-        for i in range(len(h.snapshots), 0, -1):
-            s = h.snapshots[i-1]
+        # Newest first; pair each snapshot with the one before it:
+        snapshots = h.snapshots
+        pairs = zip([None] + snapshots[:-1], snapshots)
+        for i, (prev, s) in reversed(list(enumerate(pairs, 1))):
             print('Label %i "%s" at %s' % (i, s.name, s.time))
             print('    ', s.summary())
-            if i > 1:
-                prev = h.snapshots[i-2]
-                d = Diff(prev, s)
+            if prev is not None:
+                d = s.diff_from(prev)
                 print()
                 print('    ', d.stats())
             print()
@@ -242,6 +284,7 @@ class HeapLabel(gdb.Command):
 
     @need_debuginfo
     def invoke(self, args, from_tty):
+        from heap.history import history
         s = history.add(args)
         print(s.summary())
 
@@ -255,6 +298,7 @@ class HeapDiff(gdb.Command):
 
     @need_debuginfo
     def invoke(self, args, from_tty):
+        from heap.history import history, Snapshot, Diff
         h = history
         if len(h.snapshots) == 0:
             print('(no history)')
@@ -323,6 +367,7 @@ class HeapArenas(gdb.Command):
 
     @need_debuginfo
     def invoke(self, args, from_tty):
+        from heap.glibc import glibc_arenas
         for n, arena in enumerate(glibc_arenas.arenas):
             print("Arena #%d: %s" % (n, arena.address))
 
@@ -335,6 +380,7 @@ class HeapArenaSelect(gdb.Command):
 
     @need_debuginfo
     def invoke(self, args, from_tty):
+        from heap.glibc import glibc_arenas
         arena_num = int(args)
 
         glibc_arenas.cur_arena = glibc_arenas.arenas[arena_num]
@@ -357,5 +403,9 @@ def register_commands():
     HeapArenaSelect()
     Hexdump()
 
+    gdb.events.cont.connect(_flush_chunk_cache)
+    gdb.events.new_objfile.connect(flush_caches)
+    gdb.events.exited.connect(flush_caches)
+
     from heap.cpython import register_commands as register_cpython_commands
     register_cpython_commands()
@@ -26,33 +26,47 @@ import gdb
 has_gdb_execute_to_string = True
 try:
     # This will either capture the result, or fail before executing,
-    # so in neither case should we get noise on stdout:
-    gdb.execute('info registers', to_string=True)
+    # so in neither case should we get noise on stdout.  An empty "echo" is
+    # used since it's cheap, and works even with no inferior process:
+    gdb.execute('echo', to_string=True)
 except TypeError:
     has_gdb_execute_to_string = False
 
+# Temporary file used by the fallback form of execute; it's created on first
+# use and reused (truncating it) for every subsequent command:
+_log_file = None
+
+def _get_log_file():
+    global _log_file
+    if _log_file is None:
+        import tempfile
+        _log_file = tempfile.NamedTemporaryFile('r+', delete=True)
+        gdb.execute("set logging off")
+        gdb.execute("set logging redirect off")
+    return _log_file
+
 def execute(command):
     '''Equivalent to gdb.execute(to_string=True), returning the output as
     a string rather than logging it to stdout.
 
-    On gdb versions lacking this capability, it uses redirection and temporary
-    files to achieve the same result'''
+    On gdb versions lacking this capability, it uses redirection and a
+    temporary file to achieve the same result'''
     if has_gdb_execute_to_string:
         return gdb.execute(command, to_string = True)
     else:
-        import tempfile
-        f = tempfile.NamedTemporaryFile('r', delete=True)
-        gdb.execute("set logging off")
-        gdb.execute("set logging redirect off")
+        f = _get_log_file()
+        f.seek(0)
+        f.truncate()
+        # (the logging file may have been changed since the last call, so set
+        # it every time)
         gdb.execute("set logging file %s" % f.name)
         gdb.execute("set logging redirect on")
         gdb.execute("set logging on")
         gdb.execute(command)
         gdb.execute("set logging off")
         gdb.execute("set logging redirect off")
-        result = f.read()
-        f.close()
-        return result
+        f.seek(0)
+        return f.read()
 
 def dump():
     print ('Does gdb.execute have an "to_string" keyword argument? : %s' 
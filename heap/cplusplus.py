@@ -17,26 +17,111 @@
 # C++ support
 import re
 
-import gdb
+from heap import caching_lookup_type, looks_like_ptr, on_cache_flush
 
-from heap import caching_lookup_type, looks_like_ptr
-from heap.compat import execute
+try:
+    import gdb
 
-void_ptr_ptr = caching_lookup_type('void').pointer().pointer()
+    from heap import sizeof_ptr
+    from heap.compat import execute
+
+    void_ptr_ptr = caching_lookup_type('void').pointer().pointer()
+except ImportError:
+    # Support importing the symbol-parsing functions from outside gdb
+    pass
+
+# e.g. "vtable for Foo + 8 in section .rodata of /home/david/heap/test_cplusplus"
+_VTABLE_RE = re.compile(r'vtable for (.+?) \+ ')
+
+# e.g. "0x401c70 <vtable for Foo+16>"
+_VTABLE_SYM_RE = re.compile(r'<vtable for (.+?)(?:\+\d+)?>$')
+
+def class_name_from_info_sym(line):
+    '''Given a line of output from "info sym", get the name of the class
+    whose vtable it describes, or None'''
+    m = _VTABLE_RE.match(line)
+    return m.group(1) if m else None
+
+def class_name_from_symbol(desc):
+    '''Given a pointer formatted with its symbol, get the name of the class
+    whose vtable it points into, or None'''
+    m = _VTABLE_SYM_RE.search(desc)
+    return m.group(1) if m else None
+
+# Many objects share a vtable, so memoize the class name (or None) for each
+# vtable address, rather than running "info sym" for every object:
+_vtable_name_cache = {}
+
+def clear_vtable_cache():
+    _vtable_name_cache.clear()
+
+on_cache_flush(clear_vtable_cache)
+
+def looks_like_vtable_ptr(vt):
+    '''Could this int be a vtable pointer?  It must be pointer-aligned, as
+    well as looking like a pointer'''
+    return vt != 0 and not (vt & (sizeof_ptr - 1)) and looks_like_ptr(vt)
+
+def resolve_vtables(vtable_addrs):
+    '''Populate the vtable cache for the given addresses, using a single
+    multi-line "info sym" query rather than one gdb round-trip per address'''
+    vtable_addrs = [vt for vt in set(vtable_addrs)
+                    if vt not in _vtable_name_cache]
+    if not vtable_addrs:
+        return
+    cmd = '\n'.join(['info sym (void *)0x%x' % vt for vt in vtable_addrs])
+    try:
+        lines = execute(cmd).splitlines()
+    except gdb.error:
+        lines = []
+    if len(lines) != len(vtable_addrs):
+        # Older gdb, or unexpected output; do it one at a time:
+        lines = [execute('info sym (void *)0x%x' % vt)
+                 for vt in vtable_addrs]
+    # "info sym" emits one line per query, either the symbol or "No symbol
+    # matches ...":
+    for vt, line in zip(vtable_addrs, lines):
+        _vtable_name_cache[vt] = class_name_from_info_sym(line)
+
+def prefetch_class_names(usage_list):
+    '''Scan the given Usage instances for plausible vtable pointers, and
+    resolve them all up-front, so that get_class_name hits the cache'''
+    vtable_addrs = []
+    for u in usage_list:
+        try:
+            vt = int(gdb.Value(u.start).cast(void_ptr_ptr).dereference())
+            if looks_like_vtable_ptr(vt):
+                vtable_addrs.append(vt)
+        except RuntimeError:
+            pass
+    resolve_vtables(vtable_addrs)
 
 def get_class_name(addr, size):
     # Try to detect a vtable ptr at the top of this object:
     vtable = gdb.Value(addr).cast(void_ptr_ptr).dereference()
-    if not looks_like_ptr(vtable):
+    vt = int(vtable)
+    if not looks_like_vtable_ptr(vt):
         return None
 
-    info = execute('info sym (void *)0x%x' % int(vtable))
-    # "vtable for Foo + 8 in section .rodata of /home/david/heap/test_cplusplus"
-    m = re.match('vtable for (.*) \+ (.*)', info)
-    if m:
-        return m.group(1)
-    # Not matched:
-    return None
+    if vt in _vtable_name_cache:
+        return _vtable_name_cache[vt]
+
+    name = _lookup_vtable_class(vtable)
+    _vtable_name_cache[vt] = name
+    return name
+
+def _lookup_vtable_class(vtable):
+    '''Given a (void*) gdb.Value, get the name of the class whose vtable it
+    points into, or None'''
+    try:
+        # Have gdb symbolize the pointer directly, rather than going through
+        # the CLI, e.g. "0x401c70 <vtable for Foo+16>":
+        desc = vtable.format_string(symbols=True)
+    except (AttributeError, TypeError, gdb.error):
+        # gdb.Value.format_string is only in gdb 9.2 onwards:
+        return class_name_from_info_sym(execute('info sym (void *)0x%x'
+                                                % int(vtable)))
+    return class_name_from_symbol(desc)
 
 
 def as_cplusplus_object(addr, size):
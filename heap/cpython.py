@@ -2,10 +2,14 @@
 This file is licensed under the PSF license
 '''
 import sys
+from collections import namedtuple
+from itertools import filterfalse, repeat
+
 import gdb
 from heap import WrappedPointer, caching_lookup_type, Usage, \
     type_void_ptr, fmt_addr, Category, looks_like_ptr, \
-    WrongInferiorProcess, Table
+    WrongInferiorProcess, Table, on_cache_flush, read_memory, ptr_struct, \
+    field_struct
 
 
 SIZEOF_VOID_P = type_void_ptr.sizeof
@@ -16,8 +20,13 @@ ALIGNMENT_SHIFT       = 3
 ALIGNMENT_MASK        = (ALIGNMENT - 1)
 
 # Return the number of bytes in size class I:
+_SIZE_BY_IDX = tuple([(I + 1) << ALIGNMENT_SHIFT for I in range(256)])
 def INDEX2SIZE(I):
-    return (I + 1) << ALIGNMENT_SHIFT
+    try:
+        return _SIZE_BY_IDX[I]
+    except IndexError:
+        # e.g. DUMMY_SIZE_IDX, or a corrupt pool_header:
+        return (I + 1) << ALIGNMENT_SHIFT
 
 SYSTEM_PAGE_SIZE      = (4 * 1024)
 SYSTEM_PAGE_SIZE_MASK = (SYSTEM_PAGE_SIZE - 1)
@@ -27,12 +36,67 @@ POOL_SIZE_MASK        = SYSTEM_PAGE_SIZE_MASK
 def ROUNDUP(x):
     return (x + ALIGNMENT_MASK) & ~ALIGNMENT_MASK
 
+# POOL_OVERHEAD() and the "poolp" type are needed for every pool; cache them
+# until the debuginfo changes:
+_pool_overhead = None
+_type_poolp = None
+
 def POOL_OVERHEAD():
-    return ROUNDUP(caching_lookup_type('struct pool_header').sizeof)
+    global _pool_overhead
+    if _pool_overhead is None:
+        _pool_overhead = ROUNDUP(caching_lookup_type('struct pool_header').sizeof)
+    return _pool_overhead
+
+def _clear_pool_caches():
+    global _pool_overhead, _type_poolp
+    _pool_overhead = None
+    _type_poolp = None
+
+on_cache_flush(_clear_pool_caches)
+
+# The types needed whilst examining every block, looked up once (rather than
+# on each call) by cpython_types():
+CPythonTypes = namedtuple('CPythonTypes',
+                          ('PyObject_ptr', 'PyObject_ptr_ptr', 'sizeof_PyObject',
+                           'PyVarObject_ptr', 'PyGC_Head', 'PyGC_Head_ptr',
+                           'PyDictObject_ptr', 'PyUnicodeObject_ptr'))
+_cpython_types = None
+
+def cpython_types():
+    '''Get a CPythonTypes, raising RuntimeError if the inferior isn't linked
+    against python'''
+    global _cpython_types
+    if _cpython_types is None:
+        PyObject = caching_lookup_type('PyObject')
+        PyObject_ptr = PyObject.pointer()
+        PyGC_Head = caching_lookup_type('PyGC_Head')
+        _cpython_types = CPythonTypes(
+            PyObject_ptr=PyObject_ptr,
+            PyObject_ptr_ptr=PyObject_ptr.pointer(),
+            sizeof_PyObject=PyObject.sizeof,
+            PyVarObject_ptr=caching_lookup_type('PyVarObject').pointer(),
+            PyGC_Head=PyGC_Head,
+            PyGC_Head_ptr=PyGC_Head.pointer(),
+            PyDictObject_ptr=caching_lookup_type('PyDictObject').pointer(),
+            PyUnicodeObject_ptr=caching_lookup_type('PyUnicodeObject').pointer())
+    return _cpython_types
+
+def _clear_cpython_types():
+    global _cpython_types
+    _cpython_types = None
+
+on_cache_flush(_clear_cpython_types)
+
+# Categories shared by many of the Usage instances from the arenas:
+_ALIGNMENT_WASTAGE = Category('pyarena', 'alignment wastage')
+_POOL_HEADER_OVERHEAD = Category('pyarena', 'pool_header overhead')
+_FREED_POOL_CHUNK = Category('pyarena', 'freed pool chunk')
 
 class PyArenaPtr(WrappedPointer):
     # Wrapper around a (void*) that's a Python arena's buffer (the
     # arena->address, as opposed to the (struct arena_object*) itself)
+    __slots__ = ('arenaobj', 'initial_pool_addr', 'num_pools', 'excess',
+                 'live_pools')
     @classmethod
     def from_addr(cls, p, arenaobj):
         ptr = gdb.Value(p)
@@ -48,12 +112,17 @@ class PyArenaPtr(WrappedPointer):
         # obmalloc.c sets up arenaobj->pool_address to the first pool
         # address, aligning it to POOL_SIZE_MASK:
         self.initial_pool_addr = self.as_address()
-        self.num_pools = ARENA_SIZE / POOL_SIZE
+        self.num_pools = ARENA_SIZE // POOL_SIZE
         self.excess = self.initial_pool_addr & POOL_SIZE_MASK
         if self.excess != 0:
             self.num_pools -= 1
             self.initial_pool_addr += POOL_SIZE - self.excess
 
+        # "pool_address" is a high-water-mark for activity within the arena;
+        # pools at this location or beyond haven't been initialized yet:
+        self.live_pools = (int(arenaobj.pool_address) - self.initial_pool_addr) // POOL_SIZE
+        self.live_pools = min(self.num_pools, max(0, self.live_pools))
+
     def __str__(self):
         return ('PyArenaPtr([%s->%s], %i pools [%s->%s], excess: %i tracked by %s)'
                 % (fmt_addr(self.as_address()),
@@ -71,23 +140,30 @@ class PyArenaPtr(WrappedPointer):
         '''Yield a sequence of PyPoolPtr, representing all of the pools within
         this arena'''
         # print 'num_pools:', num_pools
-        pool_addr = self.initial_pool_addr
-        for idx in range(self.num_pools):
+        if self.live_pools == 0:
+            return
 
-            # "pool_address" is a high-water-mark for activity within the arena;
-            # pools at this location or beyond haven't been initialized yet:
-            if pool_addr >= self.arenaobj.pool_address:
-                return
+        # Read all of the initialized pools in one go, and let each PyPoolPtr
+        # decode its header (and free list) from its slice of that:
+        try:
+            arena_buf = memoryview(read_memory(self.initial_pool_addr,
+                                               self.live_pools * POOL_SIZE))
+        except RuntimeError:
+            arena_buf = None
 
-            pool = PyPoolPtr.from_addr(pool_addr)
-            yield pool
-            pool_addr += POOL_SIZE
+        for idx in range(self.live_pools):
+            pool_addr = self.initial_pool_addr + idx * POOL_SIZE
+            if arena_buf is not None:
+                pool_buf = arena_buf[idx * POOL_SIZE:(idx + 1) * POOL_SIZE]
+            else:
+                pool_buf = None
+            yield PyPoolPtr.from_addr(pool_addr, pool_buf)
 
     def iter_usage(self):
         '''Yield a series of Usage instances'''
         if self.excess != 0:
             # FIXME: this size is wrong
-            yield Usage(self.as_address(), self.excess, Category('pyarena', 'alignment wastage'))
+            yield Usage(self.as_address(), self.excess, _ALIGNMENT_WASTAGE)
 
         for pool in self.iter_pools():
             # print 'pool:', pool
@@ -103,12 +179,32 @@ class PyArenaPtr(WrappedPointer):
 
 class PyPoolPtr(WrappedPointer):
     # Wrapper around Python's obmalloc.c: poolp: (struct pool_header *)
+    __slots__ = ('_buf', '_block_size', '_free_addrs')
 
     @classmethod
-    def from_addr(cls, p):
+    def from_addr(cls, p, buf=None):
         ptr = gdb.Value(p)
         ptr = ptr.cast(cls.gdb_type())
-        return cls(ptr)
+        return cls(ptr, buf)
+
+    def __init__(self, gdbval, buf=None):
+        WrappedPointer.__init__(self, gdbval)
+
+        # A copy of the pool's memory (POOL_SIZE bytes), if the caller has
+        # already read it:
+        self._buf = buf
+
+        # Cache some values:
+        self._block_size = INDEX2SIZE(self._header_field('szidx'))
+        self._free_addrs = None
+
+    def _header_field(self, fieldname):
+        '''Get an integer field of the pool_header, decoding it from the
+        buffer if we have one'''
+        if self._buf is None:
+            return int(self.field(fieldname))
+        offset, s = field_struct('struct pool_header', fieldname)
+        return s.unpack_from(self._buf, offset)[0]
 
     def __str__(self):
         return ('PyPoolPtr([%s->%s: %d blocks of size %i bytes))'
@@ -118,46 +214,53 @@ class PyPoolPtr(WrappedPointer):
     @classmethod
     def gdb_type(cls):
         # Deferred lookup of the "poolp" type:
-        return caching_lookup_type('poolp')
+        global _type_poolp
+        if _type_poolp is None:
+            _type_poolp = caching_lookup_type('poolp')
+        return _type_poolp
 
     def block_size(self):
-        return INDEX2SIZE(self.field('szidx'))
+        return self._block_size
 
     def num_blocks(self):
         firstoffset = self._firstoffset()
         maxnextoffset = self._maxnextoffset()
         offsetrange = maxnextoffset - firstoffset
-        return offsetrange / self.block_size() # FIXME: not exactly correctly
+        return offsetrange // self._block_size # FIXME: not exactly correctly
 
     def _firstoffset(self):
         return POOL_OVERHEAD()
 
     def _maxnextoffset(self):
-        return POOL_SIZE - self.block_size()
+        return POOL_SIZE - self._block_size
 
     def iter_blocks(self):
-        '''Yield all blocks within this pool, whether free or in use'''
-        size = self.block_size()
+        '''Get all blocks within this pool, whether free or in use, as
+        (addr, size) pairs'''
+        size = self._block_size
         maxnextoffset = self._maxnextoffset()
         # print initnextoffset, maxnextoffset
-        offset = self._firstoffset()
-        base_addr = self.as_address()
-        while offset <= maxnextoffset:
-            yield (base_addr + offset, size)
-            offset += size
+        base_addr = int(self.as_address())
+        return zip(range(base_addr + self._firstoffset(),
+                         base_addr + maxnextoffset + 1,
+                         size),
+                   repeat(size))
 
     def iter_usage(self):
         # The struct pool_header at the front:
         yield Usage(self.as_address(),
                     POOL_OVERHEAD(),
-                    Category('pyarena', 'pool_header overhead'))
+                    _POOL_HEADER_OVERHEAD)
 
-        fb = list(self.iter_free_blocks())
-        for (start, size) in fb:
-            yield Usage(start, size, Category('pyarena', 'freed pool chunk'))
-
-        for (start, size) in self.iter_used_blocks():
-            if (start, size) not in fb:
+        # Walk the blocks once, in address order, classifying each against
+        # the set of free blocks:
+        free_block_addresses = self._free_blocks()
+        size = self._block_size
+        freed = _FREED_POOL_CHUNK
+        for start in self._iter_allocated_addrs():
+            if start in free_block_addresses:
+                yield Usage(start, size, freed)
+            else:
                 yield Usage(start, size) #, 'python pool: ' + categorize(start, size, None))
 
         # FIXME: yield any wastage at the end
@@ -165,39 +268,59 @@ class PyPoolPtr(WrappedPointer):
     def iter_free_blocks(self):
         '''Yield the sequence of free blocks within this pool.  Doesn't include
         the areas after nextoffset that have never been allocated'''
-        # print self._gdbval.dereference()
-        size = self.block_size()
-        freeblock = self.field('freeblock')
-        _type_block_ptr_ptr = caching_lookup_type('unsigned char').pointer().pointer()
+        size = self._block_size
+        freeblock = self._header_field('freeblock')
+        base_addr = int(self.as_address())
+        # Read the whole pool in one go (if we haven't already), rather than
+        # dereferencing each link via gdb:
+        buf = self._buf
+        if buf is None:
+            buf = read_memory(base_addr, POOL_SIZE)
+        maxoffset = POOL_SIZE - ptr_struct.size
         # Walk the singly-linked list of free blocks for this chunk
-        while int(freeblock) != 0:
-            # print 'freeblock:', (fmt_addr(int(freeblock)), int(size))
-            yield (int(freeblock), int(size))
-            freeblock = freeblock.cast(_type_block_ptr_ptr).dereference()
+        while freeblock != 0:
+            # print 'freeblock:', (fmt_addr(freeblock), size)
+            yield (freeblock, size)
+            offset = freeblock - base_addr
+            if 0 <= offset <= maxoffset:
+                freeblock = ptr_struct.unpack_from(buf, offset)[0]
+            else:
+                # Pointing outside of this pool (corrupt?); read it directly:
+                freeblock = ptr_struct.unpack(read_memory(freeblock,
+                                                          ptr_struct.size))[0]
 
     def _free_blocks(self):
-        # Get the set of addresses of free blocks
-        return set([addr for addr, size in self.iter_free_blocks()])
+        # Get the set of addresses of free blocks (walking the free list on the
+        # first call only):
+        if self._free_addrs is None:
+            self._free_addrs = frozenset(addr
+                                         for addr, size in self.iter_free_blocks())
+        return self._free_addrs
 
     def iter_used_blocks(self):
-        '''Yield the sequence of currently in-use blocks within this pool'''
+        '''Get the sequence of currently in-use blocks within this pool, as
+        (addr, size) pairs'''
         # We'll filter out the free blocks from the list:
         free_block_addresses = self._free_blocks()
 
-        size = self.block_size()
+        size = self._block_size
+        # Filter out those within this pool's linked list of free blocks
+        # (doing the membership tests within filterfalse, and pairing up with
+        # the size via zip, so that no python code runs per-block):
+        return zip(filterfalse(free_block_addresses.__contains__,
+                               self._iter_allocated_addrs()),
+                   repeat(size))
+
+    def _iter_allocated_addrs(self):
+        '''Get the addresses of all blocks that have ever been allocated within
+        this pool (both those in use and those on the free list)'''
+        size = self._block_size
         initnextoffset = self._firstoffset()
-        nextoffset = self.field('nextoffset')
-        #print initnextoffset, nextoffset
-        offset = initnextoffset
-        base_addr = self.as_address()
+        nextoffset = self._header_field('nextoffset')
+        base_addr = int(self.as_address())
         # Iterate upwards until you reach "pool->nextoffset": blocks beyond
         # that point have never been allocated:
-        while offset < nextoffset:
-            addr = base_addr + offset
-            # Filter out those within this pool's linked list of free blocks:
-            if int(addr) not in free_block_addresses:
-                yield (int(addr), int(size))
-            offset += size
+        return range(base_addr + initnextoffset, base_addr + nextoffset, size)
 
 
 Py_TPFLAGS_HEAPTYPE = (1 << 9)
@@ -213,18 +336,19 @@ Py_TPFLAGS_BASE_EXC_SUBCLASS = (1 << 30)
 Py_TPFLAGS_TYPE_SUBCLASS     = (1 << 31)
 
 class PyObjectPtr(WrappedPointer):
+    __slots__ = ('_type_obj', '_tp_name')
+
     @classmethod
     def from_pyobject_ptr(cls, addr):
         ob_type = addr['ob_type']
-        tp_flags = ob_type['tp_flags']
-        if tp_flags & Py_TPFLAGS_HEAPTYPE:
-            return HeapTypeObjectPtr(addr)
-
-        if tp_flags & Py_TPFLAGS_UNICODE_SUBCLASS:
-            return PyUnicodeObjectPtr(addr.cast(caching_lookup_type('PyUnicodeObject').pointer()))
-
-        if tp_flags & Py_TPFLAGS_DICT_SUBCLASS:
-            return PyDictObjectPtr(addr.cast(caching_lookup_type('PyDictObject').pointer()))
+        tp_flags = int(ob_type['tp_flags'])
+        # Most objects have none of the flags that get special handling:
+        if tp_flags & _FLAG_HANDLERS_MASK:
+            for flag, wrapper, typefield in _FLAG_HANDLERS:
+                if tp_flags & flag:
+                    if typefield:
+                        addr = addr.cast(getattr(cpython_types(), typefield))
+                    return wrapper(addr)
 
         tp_name = ob_type['tp_name'].string()
         if tp_name == 'instance':
@@ -233,39 +357,44 @@ class PyObjectPtr(WrappedPointer):
 
         return PyObjectPtr(addr)
 
+    def __init__(self, gdbval):
+        WrappedPointer.__init__(self, gdbval)
+        self._type_obj = None
+        self._tp_name = None
+
     def type(self):
-        return PyTypeObjectPtr(self.field('ob_type'))
+        if self._type_obj is None:
+            self._type_obj = PyTypeObjectPtr(self.field('ob_type'))
+        return self._type_obj
 
     def safe_tp_name(self):
-        try:
-            return self.type().field('tp_name').string()
-        except(RuntimeError, UnicodeDecodeError):
-            # Can't even read the object at all?
-            return 'unknown'
+        # Cached, since categorization can ask for this several times per
+        # object:
+        if self._tp_name is None:
+            # This is on the hot path when categorizing every block, so use
+            # the raw gdb.Value rather than wrapping ob_type in a
+            # PyTypeObjectPtr:
+            try:
+                self._tp_name = self.field('ob_type')['tp_name'].string()
+            except(RuntimeError, UnicodeDecodeError):
+                # Can't even read the object at all?
+                self._tp_name = 'unknown'
+        return self._tp_name
 
     def categorize(self):
         # Python objects will be categorized as ("python", tp_name), but
         # old-style classes have to do more work
         return Category('python', self.safe_tp_name())
 
-    def as_malloc_addr(self):
-        ob_type = addr['ob_type']
-        tp_flags = ob_type['tp_flags']
-        addr = int(self._gdbval)
-        if tp_flags & Py_TPFLAGS_: # FIXME
-            return obj_addr_to_gc_addr(addr)
-        else:
-            return addr
-
 # Taken from my libpython.py code in python's Tools/gdb/libpython.py
 # FIXME: ideally should share code somehow
 def _PyObject_VAR_SIZE(typeobj, nitems):
-    type_size_t = caching_lookup_type('size_t')
-    return ( ( typeobj.field('tp_basicsize') +
-               nitems * typeobj.field('tp_itemsize') +
+    # Done with python ints, rather than via gdb.Value arithmetic:
+    return ( ( int(typeobj.field('tp_basicsize')) +
+               nitems * int(typeobj.field('tp_itemsize')) +
                (SIZEOF_VOID_P - 1)
              ) & ~(SIZEOF_VOID_P - 1)
-           ).cast(type_size_t)
+           )
 def int_from_int(gdbval):
     return int(gdbval)
 
@@ -274,6 +403,7 @@ class PyUnicodeObjectPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyUnicodeObject* within the process
     being debugged.
     """
+    __slots__ = ()
     _typename = 'PyUnicodeObject'
 
     def categorize_refs(self, usage_set, level=0, detail=None):
@@ -288,6 +418,7 @@ class PyDictObjectPtr(PyObjectPtr):
     Class wrapping a gdb.Value that's a PyDictObject* i.e. a dict instance
     within the process being debugged.
     """
+    __slots__ = ()
     _typename = 'PyDictObject'
 
     def categorize_refs(self, usage_set, level=0, detail=None):
@@ -298,6 +429,7 @@ class PyDictObjectPtr(PyObjectPtr):
         return True
 
 class PyInstanceObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyInstanceObject'
 
     def cl_name(self):
@@ -326,8 +458,7 @@ class PyInstanceObjectPtr(PyObjectPtr):
                                     level=1)
 
         # Visit ma_table:
-        _type_PyDictObject_ptr = caching_lookup_type('PyDictObject').pointer()
-        in_dict = in_dict.cast(_type_PyDictObject_ptr)
+        in_dict = in_dict.cast(cpython_types().PyDictObject_ptr)
 
         ma_table = int(in_dict['ma_table'])
 
@@ -338,23 +469,29 @@ class PyInstanceObjectPtr(PyObjectPtr):
         return True
 
 class PyTypeObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyTypeObject'
 
 class HeapTypeObjectPtr(PyObjectPtr):
+    __slots__ = ()
     _typename = 'PyObject'
 
     def categorize_refs(self, usage_set, level=0, detail=None):
         attr_dict = self.get_attr_dict()
         if attr_dict:
+            # (the same detail is used for both the dict and its table, so
+            # only look up our typename once):
+            dict_detail = '%s.__dict__' % self.safe_tp_name()
+
             # Mark the dictionary's "detail" with our typename
             # gdb.execute('print (PyObject*)0x%x' % int(attr_dict._gdbval))
             usage_set.set_addr_category(obj_addr_to_gc_addr(attr_dict._gdbval),
-                                        Category('python', 'dict', '%s.__dict__' % self.safe_tp_name()),
+                                        Category('python', 'dict', dict_detail),
                                         level=level+1)
 
             # and mark the dict's PyDictEntry with our typename:
             attr_dict.categorize_refs(usage_set, level=level+1,
-                                      detail='%s.__dict__' % self.safe_tp_name())
+                                      detail=dict_detail)
         return True
 
     def get_attr_dict(self):
@@ -368,7 +505,7 @@ class HeapTypeObjectPtr(PyObjectPtr):
             dictoffset = int_from_int(typeobj.field('tp_dictoffset'))
             if dictoffset != 0:
                 if dictoffset < 0:
-                    type_PyVarObject_ptr = caching_lookup_type('PyVarObject').pointer()
+                    type_PyVarObject_ptr = cpython_types().PyVarObject_ptr
                     tsize = int_from_int(self._gdbval.cast(type_PyVarObject_ptr)['ob_size'])
                     if tsize < 0:
                         tsize = -tsize
@@ -380,8 +517,7 @@ class HeapTypeObjectPtr(PyObjectPtr):
                         return None
 
                 dictptr = self._gdbval.cast(type_char_ptr) + dictoffset
-                PyObjectPtrPtr = caching_lookup_type('PyObject').pointer().pointer()
-                dictptr = dictptr.cast(PyObjectPtrPtr)
+                dictptr = dictptr.cast(cpython_types().PyObject_ptr_ptr)
                 return PyObjectPtr.from_pyobject_ptr(dictptr.dereference())
         except RuntimeError:
             # Corrupt data somewhere; fail safe
@@ -390,32 +526,103 @@ class HeapTypeObjectPtr(PyObjectPtr):
         # Not found, or some kind of error:
         return None
 
-def is_pyobject_ptr(addr):
+class PyObjectLayout(object):
+    '''The offsets and encodings of the fields that is_pyobject_ptr checks, so
+    that it can examine a candidate (and its type) via raw reads of memory,
+    rather than a gdb.Value access per field'''
+    def __init__(self):
+        self.ob_refcnt = field_struct('PyObject', 'ob_refcnt')
+        self.ob_type = field_struct('PyObject', 'ob_type')
+        self.ob_size = field_struct('PyVarObject', 'ob_size')
+        self.tp_ptr_fields = [field_struct('PyTypeObject', fieldname)
+                              for fieldname in ('tp_del', 'tp_mro',
+                                                'tp_init', 'tp_getset')]
+
+        # How many bytes to read of the object, and of its type:
+        self.object_size = max([offset + s.size
+                                for offset, s in (self.ob_refcnt, self.ob_type)])
+        self.type_size = max([offset + s.size
+                              for offset, s in ([self.ob_refcnt, self.ob_size]
+                                                + self.tp_ptr_fields)])
+
+_pyobject_layout = None
+
+def pyobject_layout():
+    global _pyobject_layout
+    if _pyobject_layout is None:
+        _pyobject_layout = PyObjectLayout()
+    return _pyobject_layout
+
+def _clear_pyobject_layout():
+    global _pyobject_layout
+    _pyobject_layout = None
+
+on_cache_flush(_clear_pyobject_layout)
+
+# Addresses of type objects that have passed the sanity checks in
+# is_pyobject_ptr.  Most blocks share a handful of types, so this saves
+# reading and checking the type for every one of them.  Only valid whilst the
+# inferior is stopped (heap types can be freed), so it's also cleared
+# whenever it continues:
+_plausible_types = set()
+
+def _clear_plausible_types(event=None):
+    _plausible_types.clear()
+
+on_cache_flush(_clear_plausible_types)
+
+def _unpack_field(buf, field):
+    offset, s = field
+    return s.unpack_from(buf, offset)[0]
+
+# The tp_flags that PyObjectPtr.from_pyobject_ptr dispatches on, in order of
+# precedence: (flag, wrapper class, CPythonTypes field to cast to, or None)
+_FLAG_HANDLERS = ((Py_TPFLAGS_HEAPTYPE, HeapTypeObjectPtr, None),
+                  (Py_TPFLAGS_UNICODE_SUBCLASS, PyUnicodeObjectPtr,
+                   'PyUnicodeObject_ptr'),
+                  (Py_TPFLAGS_DICT_SUBCLASS, PyDictObjectPtr,
+                   'PyDictObject_ptr'))
+# (the flags are distinct bits, so their sum is their union):
+_FLAG_HANDLERS_MASK = sum([flag for flag, wrapper, typefield in _FLAG_HANDLERS])
+
+def is_pyobject_ptr(addr, buf=None):
+    '''Does addr look like a PyObject*?  If the caller has already read the
+    memory at addr, it can pass it as buf (at least
+    pyobject_layout().object_size bytes) to avoid reading it again'''
     try:
-        _type_pyop = caching_lookup_type('PyObject').pointer()
-        _type_pyvarop = caching_lookup_type('PyVarObject').pointer()
+        types = cpython_types()
+        layout = pyobject_layout()
     except RuntimeError:
         # not linked against python
         return None
 
-    pyop = gdb.Value(addr).cast(_type_pyop)
     try:
-        ob_refcnt = pyop['ob_refcnt']
+        # Read the fields of the object and its type directly, and only go
+        # via gdb.Value if they look plausible:
+        if buf is None:
+            buf = read_memory(int(addr), layout.object_size)
+        ob_refcnt = _unpack_field(buf, layout.ob_refcnt)
         if ob_refcnt >=0 and ob_refcnt < 0xffff:
-            obtype = pyop['ob_type']
+            obtype = _unpack_field(buf, layout.ob_type)
+            if obtype in _plausible_types:
+                pyop = gdb.Value(addr).cast(types.PyObject_ptr)
+                return PyObjectPtr.from_pyobject_ptr(pyop)
             if obtype != 0:
-                type_refcnt = obtype.cast(_type_pyop)['ob_refcnt']
+                typebuf = read_memory(obtype, layout.type_size)
+                type_refcnt = _unpack_field(typebuf, layout.ob_refcnt)
                 if type_refcnt > 0 and type_refcnt < 0xffff:
-                    type_ob_size = obtype.cast(_type_pyvarop)['ob_size']
+                    type_ob_size = _unpack_field(typebuf, layout.ob_size)
 
                     if type_ob_size > 0xffff:
                         return 0
 
-                    for fieldname in ('tp_del', 'tp_mro', 'tp_init', 'tp_getset'):
-                        if not looks_like_ptr(obtype[fieldname]):
+                    for field in layout.tp_ptr_fields:
+                        if not looks_like_ptr(_unpack_field(typebuf, field)):
                             return 0
 
                     # Then this looks like a Python object:
+                    _plausible_types.add(obtype)
+                    pyop = gdb.Value(addr).cast(types.PyObject_ptr)
                     return PyObjectPtr.from_pyobject_ptr(pyop)
 
     except (RuntimeError, UnicodeDecodeError):
@@ -427,12 +634,11 @@ def obj_addr_to_gc_addr(addr):
     '''Given a PyObject* address, convert to a PyGC_Head* address
     (i.e. the allocator's view of the same)'''
     #print 'obj_addr_to_gc_addr(%s)' % fmt_addr(int(addr))
-    _type_PyGC_Head = caching_lookup_type('PyGC_Head')
-    return int(addr) - _type_PyGC_Head.sizeof
+    return int(addr) - cpython_types().PyGC_Head.sizeof
 
-def as_python_object(addr):
-    '''Given an address of an allocation, determine if it holds a PyObject,
-    or a PyGC_Head
+def as_python_object(addr, size=None):
+    '''Given an address of an allocation (and optionally, its size),
+    determine if it holds a PyObject, or a PyGC_Head
 
     Return a WrappedPointer for the PyObject* if it does (which might have a
     different location c.f. when PyGC_Head was allocated)
@@ -441,24 +647,36 @@ def as_python_object(addr):
     # Try casting to PyObject* ?
     # FIXME: what about the debug allocator?
     try:
-        _type_pyop = caching_lookup_type('PyObject').pointer()
-        _type_PyGC_Head = caching_lookup_type('PyGC_Head')
+        types = cpython_types()
     except RuntimeError:
         # not linked against python
         return None
-    pyop = is_pyobject_ptr(addr)
+    # Fast rejection of allocations too small to hold a PyObject:
+    if size is not None and size < types.sizeof_PyObject:
+        return None
+    _type_PyGC_Head = types.PyGC_Head
+    # Read enough for both a PyObject at addr, and for one following a
+    # PyGC_Head at addr, in a single call:
+    gc_size = _type_PyGC_Head.sizeof
+    try:
+        buf = memoryview(read_memory(int(addr),
+                                     gc_size + pyobject_layout().object_size))
+    except RuntimeError:
+        # e.g. too near the end of a mapping; read each one separately:
+        buf = None
+    pyop = is_pyobject_ptr(addr, buf)
     if pyop:
         return pyop
     else:
         # maybe a GC type:
-        _type_PyGC_Head_ptr = _type_PyGC_Head.pointer()
-        gc_ptr = gdb.Value(addr).cast(_type_PyGC_Head_ptr)
+        gc_ptr = gdb.Value(addr).cast(types.PyGC_Head_ptr)
         # print gc_ptr.dereference()
 
         PYGC_REFS_REACHABLE = -3
 
         if gc_ptr['gc']['gc_refs'] == PYGC_REFS_REACHABLE:  # FIXME: need to cover other values
-            pyop = is_pyobject_ptr(gdb.Value(addr + _type_PyGC_Head.sizeof))
+            pyop = is_pyobject_ptr(gdb.Value(addr + gc_size),
+                                   buf[gc_size:] if buf is not None else None)
             if pyop:
                 return pyop
     # Doesn't look like a python object, implicit return None
@@ -470,6 +688,8 @@ class ArenaObject(WrappedPointer):
     Note that this is record-keeping for an arena, not the
     memory itself
     '''
+    __slots__ = ('pool_address',)
+
     @classmethod
     def iter_arenas(cls):
         try:
@@ -480,13 +700,21 @@ class ArenaObject(WrappedPointer):
             raise WrongInferiorProcess('cpython')
 
         try:
-            for i in range(val_maxarenas):
-                # Look up "&arenas[i]":
-                obj = ArenaObject(val_arenas[i].address)
+            maxarenas = int(val_maxarenas)
+            if maxarenas == 0:
+                return
+
+            # Read the whole "arenas" array in one go, so that we only need to
+            # go via gdb.Value for the entries that are in use:
+            sizeof_arena_object = caching_lookup_type('struct arena_object').sizeof
+            offset, s = field_struct('struct arena_object', 'address')
+            buf = read_memory(int(val_arenas), maxarenas * sizeof_arena_object)
 
+            for i in range(maxarenas):
                 # obj->address == 0 indicates an unused entry within the "arenas" array:
-                if obj.address != 0:
-                    yield obj
+                if s.unpack_from(buf, i * sizeof_arena_object + offset)[0] != 0:
+                    # Look up "&arenas[i]":
+                    yield ArenaObject(val_arenas[i].address)
         except RuntimeError:
             # pypy also has a symbol named "arenas", of type "long unsigned int * volatile"
             # For now, ignore it:
@@ -510,17 +738,22 @@ class ArenaDetection(object):
     def __init__(self):
         self.arenaobjs = list(ArenaObject.iter_arenas())
 
+        # Index the arenas by the address of their buffer, for as_arena (which
+        # is called for every chunk of the heap):
+        self._arenaobj_by_addr = dict([(int(arenaobj.address), arenaobj)
+                                       for arenaobj in self.arenaobjs])
+
     def as_arena(self, ptr, chunksize):
         '''Detect if this ptr returned by malloc is in use as a Python arena,
         returning PyArenaPtr if it is, None if not'''
         # Fast rejection of too-small chunks:
-        if chunksize < (256 * 1024):
+        if chunksize < ARENA_SIZE:
             return None
 
-        for arenaobj in self.arenaobjs:
-            if ptr == arenaobj.address:
-                # Found it:
-                return PyArenaPtr.from_addr(ptr, arenaobj)
+        arenaobj = self._arenaobj_by_addr.get(int(ptr))
+        if arenaobj is not None:
+            # Found it:
+            return PyArenaPtr.from_addr(ptr, arenaobj)
 
         # Not found:
         return None
@@ -598,12 +831,14 @@ class HeapCPythonAllocators(gdb.Command):
     @need_debuginfo
     def invoke(self, args, from_tty):
         t = Table(columnheadings=('struct arena_object*', '256KB buffer location', 'Free pools'))
+        _fmt_addr = fmt_addr
+        add_row = t.add_row
         for arena in ArenaObject.iter_arenas():
-            t.add_row([fmt_addr(arena.as_address()),
-                       fmt_addr(arena.address),
-                       '%i / %i ' % (arena.field('nfreepools'),
-                                     arena.field('ntotalpools'))
-                       ])
+            add_row((_fmt_addr(arena.as_address()),
+                     _fmt_addr(int(arena.address)),
+                     '%i / %i ' % (int(arena.field('nfreepools')),
+                                   int(arena.field('ntotalpools')))
+                     ))
         print('Objects/obmalloc.c: %i arenas' % len(t.rows))
         t.write(sys.stdout)
         print()
@@ -611,3 +846,5 @@ class HeapCPythonAllocators(gdb.Command):
 
 def register_commands():
     HeapCPythonAllocators()
+
+    gdb.events.cont.connect(_clear_plausible_types)
@@ -23,12 +23,43 @@ e.g. /usr/src/debug/glibc-2.11.1/malloc/malloc.h and /usr/src/debug/glibc-2.11.1
 This file is licenced under the LGPLv2.1
 '''
 
-import re
-
 import gdb
 
 from heap import WrappedPointer, WrappedValue, caching_lookup_type, \
-    type_char_ptr, check_missing_debuginfo, array_length, offsetof
+    type_char_ptr, check_missing_debuginfo, array_length, offsetof, \
+    on_cache_flush, read_memory, field_struct, ptr_struct
+
+# Values needed for every chunk whilst walking the heap; looked up on first
+# use, and discarded when the debuginfo changes:
+_SIZE_SZ = None
+_type_mchunkptr = None
+
+def get_SIZE_SZ():
+    '''Get malloc.c's SIZE_SZ i.e. sizeof(size_t) in the inferior'''
+    global _SIZE_SZ
+    if _SIZE_SZ is None:
+        _SIZE_SZ = caching_lookup_type('size_t').sizeof
+    return _SIZE_SZ
+
+def get_type_mchunkptr():
+    global _type_mchunkptr
+    if _type_mchunkptr is None:
+        _type_mchunkptr = caching_lookup_type('mchunkptr')
+    return _type_mchunkptr
+
+def _clear_type_caches():
+    global _SIZE_SZ, _type_mchunkptr
+    _SIZE_SZ = None
+    _type_mchunkptr = None
+
+on_cache_flush(_clear_type_caches)
+
+def _read_chunk_size(addr):
+    '''Read the size field (flags included) of the chunk at the given address
+    directly from the inferior's memory'''
+    offset, size_struct = field_struct('struct malloc_chunk', 'mchunk_size')
+    size, = size_struct.unpack(read_memory(addr + offset, size_struct.size))
+    return size
 
 class MChunkPtr(WrappedPointer):
     '''Wrapper around glibc's mchunkptr
@@ -61,15 +92,32 @@ class MChunkPtr(WrappedPointer):
 
     SIZE_BITS = (PREV_INUSE|IS_MMAPPED|NON_MAIN_ARENA)
 
+    # There can be a great many of these whilst walking the heap:
+    __slots__ = ('_cached_size',)
+
+    def __init__(self, gdbval):
+        WrappedPointer.__init__(self, gdbval)
+        # Value of the size field (flags included), once it has been read:
+        self._cached_size = None
+
     @classmethod
     def gdb_type(cls):
         # Deferred lookup of the "mchunkptr" type:
-        return caching_lookup_type('mchunkptr')
+        return get_type_mchunkptr()
+
+    @classmethod
+    def from_decoded(cls, addr, size):
+        '''Construct from the address of a chunk, along with the value of its
+        size field (flags included), already read from the inferior'''
+        chunk = cls(gdb.Value(addr).cast(cls.gdb_type()))
+        chunk._cached_size = size
+        return chunk
 
     def size(self):
-        if not(hasattr(self, '_cached_size')):
-            self._cached_size = int(self.field('mchunk_size'))
-        return self._cached_size
+        size = self._cached_size
+        if size is None:
+            size = self._cached_size = int(self.field('mchunk_size'))
+        return size
 
     def chunksize(self):
         return self.size() & ~(self.SIZE_BITS)
@@ -104,15 +152,14 @@ class MChunkPtr(WrappedPointer):
                 result += ' inuse'
             else:
                 result += ' free'
-        SIZE_SZ = caching_lookup_type('size_t').sizeof
+        SIZE_SZ = get_SIZE_SZ()
         result += ' chunksize=%i memsize=%i>' % (self.chunksize(),
                                                  self.chunksize() - (2 * SIZE_SZ))
         return result
 
     def as_mem(self):
         # Analog of chunk2mem: the address as seen by the program (e.g. malloc)
-        SIZE_SZ = caching_lookup_type('size_t').sizeof
-        return self.as_address() + (2 * SIZE_SZ)
+        return self.as_address() + (2 * get_SIZE_SZ())
 
     def is_inuse(self):
         # Is this chunk is use?
@@ -126,23 +173,21 @@ class MChunkPtr(WrappedPointer):
     def next_chunk(self):
         # Analog of:
         #   #define next_chunk(p) ((mchunkptr)( ((char*)(p)) + ((p)->size & ~SIZE_BITS) ))
-        ptr = self._gdbval.cast(type_char_ptr)
-        cs = self.chunksize()
-        ptr += cs
-        ptr = ptr.cast(MChunkPtr.gdb_type())
-        #print 'next_chunk returning: 0x%x' % ptr
-        return MChunkPtr(ptr)
+        # Do the arithmetic on the integer address, rather than casting to
+        # (char*) and back:
+        addr = self.as_address() + self.chunksize()
+        #print 'next_chunk returning: 0x%x' % addr
+        return MChunkPtr(gdb.Value(addr).cast(get_type_mchunkptr()))
 
     def prev_chunk(self):
         # Analog of:
         #   #define prev_chunk(p) ((mchunkptr)( ((char*)(p)) - ((p)->prev_size) ))
-        ptr = self._gdbval.cast(type_char_ptr)
-        ptr -= self.field('prev_size')
-        ptr = ptr.cast(MChunkPtr.gdb_type())
-        return MChunkPtr(ptr)
+        addr = self.as_address() - int(self.field('prev_size'))
+        return MChunkPtr(gdb.Value(addr).cast(get_type_mchunkptr()))
 
 class MBinPtr(MChunkPtr):
     # Wrapper around an "mbinptr"
+    __slots__ = ()
 
     @classmethod
     def gdb_type(cls):
@@ -157,7 +202,13 @@ class MBinPtr(MChunkPtr):
 
 class MFastBinPtr(MChunkPtr):
     # Wrapped around a mfastbinptr
-    pass
+    __slots__ = ()
+
+# Upper limit on the size of a single read whilst walking the sbrk heap:
+SBRK_READ_SIZE = 1 << 20
+
+# Upper limit on the number of chunks to follow along a single free list:
+MAX_FREE_LIST_LENGTH = 1000000
 
 class MallocState(WrappedValue):
     # Wrapper around struct malloc_state, as defined in malloc.c
@@ -192,23 +243,62 @@ class MallocState(WrappedValue):
         for c in self.iter_sbrk_chunks():
             yield c
 
+    def iter_chunk_tuples(self):
+        '''Yield a sequence of (addr, chunksize, inuse) tuples for all chunks
+        of memory in the heap, as per iter_chunks, but without wrapping each
+        one in a MChunkPtr, for callers that only need the numbers'''
+        SIZE_BITS = MChunkPtr.SIZE_BITS
+        PREV_INUSE = MChunkPtr.PREV_INUSE
+
+        # (mmapped chunks are always in use)
+        for addr, size in self._iter_mmap_sizes():
+            yield (addr, size & ~SIZE_BITS, True)
+
+        # Whether a chunk is in use is recorded in the size field of the
+        # chunk that follows it, so we need to look one chunk ahead:
+        prev_addr = None
+        for addr, size in self._iter_sbrk_sizes():
+            if prev_addr is not None:
+                yield (prev_addr, prev_chunksize, bool(size & PREV_INUSE))
+            prev_addr, prev_chunksize = addr, size & ~SIZE_BITS
+        if prev_addr is not None:
+            # The chunk after the final one is typically "top":
+            try:
+                size = _read_chunk_size(prev_addr + prev_chunksize)
+            except RuntimeError:
+                return
+            yield (prev_addr, prev_chunksize, bool(size & PREV_INUSE))
+
     def iter_mmap_chunks(self):
+        for addr, size in self._iter_mmap_sizes():
+            yield MChunkPtr.from_decoded(addr, size)
+
+    def _iter_mmap_sizes(self):
+        '''Yield (addr, size) pairs for the chunks within mmapped regions of
+        memory, where size is the raw value of the size field (flags
+        included)'''
+        IS_MMAPPED = MChunkPtr.IS_MMAPPED
+        NON_MAIN_ARENA = MChunkPtr.NON_MAIN_ARENA
+        SIZE_BITS = MChunkPtr.SIZE_BITS
         for inf in gdb.inferiors():
             for (start, end) in iter_mmap_heap_chunks(inf.pid):
                 # print "Trying 0x%x-0x%x" % (start, end)
                 try:
-                    chunk = MChunkPtr(gdb.Value(start).cast(MChunkPtr.gdb_type()))
+                    addr = start
+                    size = _read_chunk_size(addr)
                     # Does this look like the first chunk within a range of
                     # mmap address space?
-                    #print ('0x%x' % chunk.as_address() + chunk.chunksize())
-                    if (not chunk.has_NON_MAIN_ARENA() and chunk.has_IS_MMAPPED()
-                        and chunk.as_address() + chunk.chunksize() <= end):
+                    if (not size & NON_MAIN_ARENA and size & IS_MMAPPED
+                        and addr + (size & ~SIZE_BITS) <= end):
 
                         # Iterate upwards until you reach "end" of mmap space:
-                        while chunk.as_address() < end and chunk.has_IS_MMAPPED():
-                            yield chunk
-                            # print '0x%x' % chunk.as_address(), chunk
-                            chunk = chunk.next_chunk()
+                        while size & IS_MMAPPED:
+                            yield (addr, size)
+                            # print '0x%x' % addr, size
+                            addr += size & ~SIZE_BITS
+                            if addr >= end:
+                                break
+                            size = _read_chunk_size(addr)
                 except RuntimeError:
                     pass
 
@@ -216,6 +306,12 @@ class MallocState(WrappedValue):
         '''Yield a sequence of MChunkPtr corresponding to all chunks of memory
         in the heap (both used and free), in order of ascending address, for those
         from sbrk_base upwards'''
+        for addr, size in self._iter_sbrk_sizes():
+            yield MChunkPtr.from_decoded(addr, size)
+
+    def _iter_sbrk_sizes(self):
+        '''Yield (addr, size) pairs for the chunks from sbrk_base upwards,
+        where size is the raw value of the size field (flags included)'''
         # FIXME: this is currently a hack; I need to verify my logic here
 
         # As I understand it, it's only possible to navigate the following ways:
@@ -234,18 +330,38 @@ class MallocState(WrappedValue):
         # and thus iterate over all of the chunks
 
         # Start at "mp_.sbrk_base"
-        chunk = MChunkPtr(gdb.Value(sbrk_base()).cast(MChunkPtr.gdb_type()))
+        addr = int(sbrk_base())
         # sbrk_base is NULL when no small allocations have happened:
-        if chunk.as_address() > 0:
-            # Iterate upwards until you reach "top":
-            top = int(self.field('top'))
-            while chunk.as_address() != top:
-                yield chunk
-                # print '0x%x' % chunk.as_address(), chunk
+        if addr == 0:
+            return
+
+        # Rather than reading each chunk's size field via gdb, read the heap
+        # in slabs of up to SBRK_READ_SIZE bytes, and decode the sizes from
+        # those:
+        offset, size_struct = field_struct('struct malloc_chunk', 'mchunk_size')
+        header_size = offset + size_struct.size
+        SIZE_BITS = MChunkPtr.SIZE_BITS
+        buf = b''
+        buf_start = addr
+
+        # Iterate upwards until you reach "top":
+        top = int(self.field('top'))
+        while addr != top:
+            if addr - buf_start + header_size > len(buf):
+                buf_start = addr
+                length = max(min(SBRK_READ_SIZE, top - addr), header_size)
                 try:
-                    chunk = chunk.next_chunk()
+                    buf = read_memory(addr, length)
                 except RuntimeError:
                     break
+            size = size_struct.unpack_from(buf, addr - buf_start + offset)[0]
+            yield (addr, size)
+            # print '0x%x' % addr, size
+            chunksize = size & ~SIZE_BITS
+            if chunksize == 0:
+                # Corrupt; we'd never make any progress:
+                break
+            addr += chunksize
 
 
 
@@ -253,17 +369,38 @@ class MallocState(WrappedValue):
         '''Yield a sequence of MChunkPtr (some of which may be MFastBinPtr),
         corresponding to the free chunks of memory'''
         # Account for top:
-        print('top')
+        #print('top')
         yield MChunkPtr(self.field('top'))
 
+        # Read the header of each chunk on a free list (up to and including
+        # the link pointer) in one go, rather than a field at a time:
+        size_offset, size_struct = field_struct('struct malloc_chunk',
+                                                'mchunk_size')
+        fd_offset = offsetof('struct malloc_chunk', 'fd')
+        bk_offset = offsetof('struct malloc_chunk', 'bk')
+
+        def iter_list(cls, addr, end, link_offset, name):
+            header_size = link_offset + ptr_struct.size
+            n = 0
+            while addr != end:
+                if n >= MAX_FREE_LIST_LENGTH:
+                    # Either enormous, or (more likely) corrupt and cyclic:
+                    print('%s: giving up after %i chunks' % (name, n))
+                    return
+                n += 1
+                buf = read_memory(addr, header_size)
+                size, = size_struct.unpack_from(buf, size_offset)
+                yield cls.from_decoded(addr, size)
+                addr, = ptr_struct.unpack_from(buf, link_offset)
+
         NFASTBINS = self.NFASTBINS()
         # Traverse fastbins:
         for i in range(0, int(NFASTBINS)):
-            print('fastbin %i' % i)
+            #print('fastbin %i' % i)
             p = self.fastbin(i)
-            while not p.is_null():
-                yield p
-                p = MFastBinPtr(p.field('fd'))
+            for c in iter_list(MFastBinPtr, p.as_address(), 0,
+                               fd_offset, 'fastbin %i' % i):
+                yield c
 
         #   for (p = fastbin (av, i); p != 0; p = p->fd) {
         #     ++nfastblocks;
@@ -277,19 +414,12 @@ class MallocState(WrappedValue):
 
         # Traverse regular bins:
         for i in range(1, NBINS):
-            print('regular bin %i' % i)
+            #print('regular bin %i' % i)
             b = self.bin_at(i)
             #print 'b: %s' % b
-            p = b.last()
-            n = 0
-            #print 'p:', p
-            while p.as_address() != b.as_address():
-                #print 'n:', n
-                #print 'b:', b
-                #print 'p:', p
-                n+=1
-                yield p
-                p = MChunkPtr(p.field('bk'))
+            for c in iter_list(MChunkPtr, b.last().as_address(), b.as_address(),
+                               bk_offset, 'regular bin %i' % i):
+                yield c
         #    for (p = last(b); p != b; p = p->bk) {
         #        ++nblocks;
         #          avail += chunksize(p);
@@ -388,27 +518,27 @@ def iter_mmap_heap_chunks(pid):
         # e.g.:
         # 38e441e000-38e441f000 rw-p 0001e000 fd:01 1087                           /lib64/ld-2.11.1.so
         # 38e441f000-38e4420000 rw-p 00000000 00:00 0
-        hexd = r'[0-9a-f]'
-        hexdigits = '(' + hexd + '+)'
-        m = re.match(hexdigits + '-' + hexdigits
-                     + r' ([r\-][w\-][x\-][ps]) ' + hexdigits
-                     + r' (..:..) (\d+)\s+(.*)',
-                     line)
-        if m:
-            # print m.groups()
-            start, end, perms, offset, dev, inode, pathname = m.groups()
-            # PROT_READ, PROT_WRITE, MAP_PRIVATE:
-            if perms == 'rw-p':
-                if offset == '00000000': # FIXME bits?
-                    if dev == '00:00': # FIXME
-                        if inode == '0': # FIXME
-                            if pathname == '': # FIXME
-                                # print 'heap line?:', line
-                                # print m.groups()
-                                start, end = [int(m.group(i), 16) for i in (1, 2)]
-                                yield (start, end)
-        else:
+        # (plain string splitting is much cheaper than a regex here, and
+        # /proc/PID/maps can be long):
+        fields = line.split(None, 5)
+        if len(fields) < 5:
             print('unmatched :', line)
+            continue
+        addrs, perms, offset, dev, inode = fields[:5]
+        if len(fields) == 6:
+            pathname = fields[5].rstrip('\n')
+        else:
+            pathname = ''
+        # PROT_READ, PROT_WRITE, MAP_PRIVATE:
+        if perms == 'rw-p':
+            if offset == '00000000': # FIXME bits?
+                if dev == '00:00': # FIXME
+                    if inode == '0': # FIXME
+                        if pathname == '': # FIXME
+                            # print 'heap line?:', line
+                            start, end = [int(addr, 16)
+                                          for addr in addrs.split('-')]
+                            yield (start, end)
 
 class GlibcArenas(object):
     def __init__(self):
@@ -19,7 +19,8 @@ import sys
 
 import gdb
 
-from heap import WrappedPointer, WrappedValue, caching_lookup_type, type_char_ptr, Category
+from heap import WrappedPointer, WrappedValue, caching_lookup_type, type_char_ptr, Category, \
+    on_cache_flush
 
 # Use glib's pretty-printers:
 dir_ = '/usr/share/glib-2.0/gdb'
@@ -27,6 +28,24 @@ if not dir_ in sys.path:
     sys.path.insert(0, dir_)
 from glib_gdb import read_global_var, g_quark_to_string
 
+# (GTypeInstance*), looked up on first use:
+_type_GTypeInstance_ptr = None
+
+# Resolved types, keyed by GType value: a (typenode, typename) pair.  Most
+# instances on the heap share a handful of types, so this saves walking the
+# type system (with an inferior call to get the name) for every one of them:
+_gtype_cache = {}
+
+# Strings for GQuark values, to avoid repeating g_quark_to_string:
+_quark_name_cache = {}
+
+def _clear_gtype_caches():
+    global _type_GTypeInstance_ptr
+    _type_GTypeInstance_ptr = None
+    _gtype_cache.clear()
+    _quark_name_cache.clear()
+
+on_cache_flush(_clear_gtype_caches)
 
 # This was adapted from glib's gobject.py:g_type_to_name
 def get_typenode_for_gtype(gtype):
@@ -49,20 +68,15 @@ def get_typenode_for_gtype(gtype):
     else:
         return lookup_fundamental_type (typenode)
 
+# Prefixes of type names that we expect to have debuginfo for:
+_CASTABLE_PREFIXES = ('Gtk', 'Gdk', 'GType', 'Pango', 'GVfs')
+
 def is_typename_castable(typename):
-    if typename.startswith('Gtk'):
-        return True
-    if typename.startswith('Gdk'):
-        return True
-    if typename.startswith('GType'):
-        return True
-    if typename.startswith('Pango'):
-        return True
-    if typename.startswith('GVfs'):
-        return True
-    return False
+    return typename.startswith(_CASTABLE_PREFIXES)
 
 class GTypeInstancePtr(WrappedPointer):
+    __slots__ = ('typenode', 'typename')
+
     @classmethod
     def from_gtypeinstance_ptr(cls, addr, typenode):
         typename = cls.get_type_name(typenode)
@@ -113,16 +127,25 @@ class GTypeInstancePtr(WrappedPointer):
 
     @classmethod
     def get_type_name(cls, typenode):
-        return g_quark_to_string(typenode["qname"])
+        qname = typenode["qname"]
+        q = int(qname)
+        if q in _quark_name_cache:
+            return _quark_name_cache[q]
+        name = _quark_name_cache[q] = g_quark_to_string(qname)
+        return name
 
 
 class GdkColormapPtr(GTypeInstancePtr):
+    __slots__ = ()
+
     def categorize_refs(self, usage_set, level=0, detail=None):
         # print 'got here 46'
         pass
         # GdkRgbInfo is stored as qdata on a GdkColormap
 
 class GdkImagePtr(GTypeInstancePtr):
+    __slots__ = ()
+
     def categorize_refs(self, usage_set, level=0, detail=None):
         priv_type = caching_lookup_type('GdkImagePrivateX11').pointer()
         priv_data = WrappedPointer(self._gdbval['windowing_data'].cast(priv_type))
@@ -144,6 +167,8 @@ class GdkImagePtr(GTypeInstancePtr):
                                     level=level+2, debug=True)
 
 class GdkPixbufPtr(GTypeInstancePtr):
+    __slots__ = ()
+
     def categorize_refs(self, usage_set, level=0, detail=None):
         dims = '%sw x %sh' % (self._gdbval['width'],
                               self._gdbval['height'])
@@ -152,6 +177,8 @@ class GdkPixbufPtr(GTypeInstancePtr):
                                     level=level+1, debug=True)
 
 class PangoCairoFcFontMapPtr(GTypeInstancePtr):
+    __slots__ = ()
+
     def categorize_refs(self, usage_set, level=0, detail=None):
         # This gives us access to the freetype library:
         FT_Library = WrappedPointer(self._gdbval['library'])
@@ -180,17 +207,24 @@ typemap = {
 
 
 def as_gtype_instance(addr, size):
+    global _type_GTypeInstance_ptr
     #type_GObject_ptr = caching_lookup_type('GObject').pointer()
-    try:
-        type_GTypeInstance_ptr = caching_lookup_type('GTypeInstance').pointer()
-    except RuntimeError:
-        # Not linked against GLib?
-        return None
+    if _type_GTypeInstance_ptr is None:
+        try:
+            _type_GTypeInstance_ptr = caching_lookup_type('GTypeInstance').pointer()
+        except RuntimeError:
+            # Not linked against GLib?
+            return None
 
-    gobj = gdb.Value(addr).cast(type_GTypeInstance_ptr)
+    gobj = gdb.Value(addr).cast(_type_GTypeInstance_ptr)
     try:
-        gtype = gobj['g_class']['g_type']
+        gtype = int(gobj['g_class']['g_type'])
         #print 'gtype', gtype
+        cached = _gtype_cache.get(gtype)
+        if cached is not None:
+            typenode, typename = cached
+            cls = GTypeInstancePtr.get_class_for_typename(typename)
+            return cls(addr, typenode, typename)
         typenode = get_typenode_for_gtype(gtype)
         # If I remove the next line, we get errors like:
         #   Cannot access memory at address 0xd1a712caa5b6e5c0
@@ -200,7 +234,12 @@ def as_gtype_instance(addr, size):
         # if typenode:
         if typenode is not None:
             #print 'typenode.dereference()', typenode.dereference()
-            return GTypeInstancePtr.from_gtypeinstance_ptr(addr, typenode)
+            result = GTypeInstancePtr.from_gtypeinstance_ptr(addr, typenode)
+            if result is not None:
+                # Only cache successful lookups; a random buffer would
+                # otherwise fill the cache with junk:
+                _gtype_cache[gtype] = (typenode, result.typename)
+            return result
     except RuntimeError:
         # Any random buffer that we point this at that isn't a GTypeInstance (or
         # GObject) is likely to raise a RuntimeError at some point in the above
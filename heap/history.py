@@ -15,32 +15,174 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import datetime
-from heap import iter_usage_with_progress, fmt_size, fmt_addr, sign
+from array import array
+from bisect import bisect_left
+from operator import attrgetter
+
+from heap import iter_usage_with_progress, fmt_size, fmt_addr, sign, Usage, \
+    ProgressNotifier, read_memory_regions, ptr_struct
+
+# One line of Diff.chunk_report:
+_ROW = '  %s -> %s %8i bytes %20s |%s\n'
+
+def _type_word_offset(u):
+    '''Get the offset within a categorized block of the pointer identifying
+    what kind of thing it holds'''
+    from heap.cpython import PyObjectPtr, pyobject_layout
+    if isinstance(u.obj, PyObjectPtr):
+        # (the PyObject may follow a PyGC_Head):
+        return (u.obj.as_address() - u.start) + pyobject_layout().ob_type[0]
+    return 0
+
+def _read_type_words(offsets):
+    '''Given a dict mapping block addresses to offsets within those blocks,
+    read the pointer at each such location, in bulk, returning a dict mapping
+    block addresses to pointers (omitting any that couldn't be read)'''
+    starts = sorted(offsets)
+    regions = read_memory_regions([(start + offsets[start], ptr_struct.size)
+                                   for start in starts])
+    result = {}
+    for start, buf in zip(starts, regions):
+        if buf is not None:
+            result[start], = ptr_struct.unpack(buf)
+    return result
 
 class Snapshot(object):
-    '''Snapshot of the state of the heap'''
+    '''Snapshot of the state of the heap
+
+    Rather than holding on to a Usage instance per block, the blocks are
+    stored as parallel arrays of start address, size, category index (into a
+    list of the distinct categories seen), and the offset and value of the
+    pointer identifying the block's type, if known (or -1 and 0), sorted by
+    start address'''
     def __init__(self, name, time):
         self.name = name
         self.time = time
-        self._all_usage = set()
+        self._starts = array('Q')
+        self._sizes = array('Q')
+        self._category_ids = array('i')
+        self._type_offsets = array('i')
+        self._type_words = array('Q')
+        # Distinct Category instances, and their indices within that list:
+        self._categories = []
+        self._category_index = {}
         self._totalsize = 0
         self._num_usage = 0
+        # Diffs against earlier snapshots, keyed by that snapshot:
+        self._diff_cache = {}
 
-    def _add_usage(self, u):
-        self._all_usage.add(u)
+    def _add_usage(self, u, type_offset=-1, type_word=0):
+        category = u.category
+        catid = self._category_index.get(category)
+        if catid is None:
+            catid = self._category_index[category] = len(self._categories)
+            self._categories.append(category)
+        self._starts.append(u.start)
+        self._sizes.append(u.size)
+        self._category_ids.append(catid)
+        self._type_offsets.append(type_offset)
+        self._type_words.append(type_word)
         self._totalsize += u.size
         self._num_usage += 1
         return u
 
+    def _sort(self):
+        # Put the blocks into order of ascending address, so that they can be
+        # located with a binary search:
+        starts = self._starts
+        if all(starts[i] < starts[i + 1] for i in range(len(starts) - 1)):
+            return
+        order = sorted(range(len(starts)), key=starts.__getitem__)
+        self._starts = array('Q', [starts[i] for i in order])
+        self._sizes = array('Q', [self._sizes[i] for i in order])
+        self._category_ids = array('i', [self._category_ids[i] for i in order])
+        self._type_offsets = array('i', [self._type_offsets[i] for i in order])
+        self._type_words = array('Q', [self._type_words[i] for i in order])
+
     @classmethod
-    def current(cls, name):
+    def current(cls, name, prev=None):
+        '''Take a snapshot of the heap as it is now.
+
+        If given an earlier snapshot, reuse its category for any block with
+        the same address and size, provided that the pointer identifying the
+        block's type (ob_type for a Python object, otherwise the first word,
+        e.g. a C++ vtable or GObject class) is unchanged.  Address and size
+        alone aren't enough: freed and reallocated memory (e.g. a CPython pool
+        slot, or a recycled malloc chunk) often comes back with the same
+        address and size but holding a different type.
+
+        These pointers are only read for blocks that match one in the earlier
+        snapshot, so a block's category is first reused in the third snapshot
+        to contain it'''
         result = cls(name, datetime.datetime.now())
-        for i, u in enumerate(iter_usage_with_progress()):
+        usage_list = list(iter_usage_with_progress())
+
+        # The index within prev of each block at the same address and size:
+        matches = {}
+        if prev is not None:
+            for u in usage_list:
+                i = prev._match(u.start, u.size)
+                if i is not None:
+                    matches[u.start] = i
+
+        # (offset, pointer) identifying the type of each matching block:
+        type_words = {}
+
+        # Reuse prev's category where the pointer is unchanged:
+        offsets = dict([(start, prev._type_offsets[i])
+                        for start, i in matches.items()
+                        if prev._type_offsets[i] >= 0])
+        words = _read_type_words(offsets)
+        for u in usage_list:
+            if u.category is None and u.start in words:
+                i = matches[u.start]
+                if words[u.start] == prev._type_words[i]:
+                    u.category = prev._categories[prev._category_ids[i]]
+                    type_words[u.start] = (offsets[u.start], words[u.start])
+
+        for u in ProgressNotifier(iter(usage_list), 'Blocks analyzed'):
             u.ensure_category()
-            u.ensure_hexdump()
-            result._add_usage(u)
+
+        # Record the pointers of the other matching blocks, for the next
+        # snapshot to check against:
+        offsets = dict([(u.start, _type_word_offset(u)) for u in usage_list
+                        if u.start in matches and u.start not in type_words])
+        words = _read_type_words(offsets)
+        for start, word in words.items():
+            type_words[start] = (offsets[start], word)
+
+        for u in usage_list:
+            # Hexdumps are read on demand, by Diff.chunk_report:
+            result._add_usage(u, *type_words.get(u.start, (-1, 0)))
+        result._sort()
         return result
 
+    def _index_of(self, address):
+        i = bisect_left(self._starts, address)
+        if i == len(self._starts) or self._starts[i] != address:
+            raise KeyError(address)
+        return i
+
+    def _match(self, address, size):
+        '''Get the index of the block at the given address, if there is one
+        with the given size, or None'''
+        i = bisect_left(self._starts, address)
+        if i < len(self._starts) and self._starts[i] == address \
+                and self._sizes[i] == size:
+            return i
+
+    def _usage_at(self, i):
+        '''Reconstruct the Usage for the i-th block'''
+        return Usage(self._starts[i], self._sizes[i],
+                     self._categories[self._category_ids[i]])
+
+    def usage_by_address(self, address):
+        return self._usage_at(self._index_of(address))
+
+    @property
+    def _all_usage(self):
+        return [self._usage_at(i) for i in range(self._num_usage)]
+
     def total_size(self):
         '''Get total allocated size, in bytes'''
         return self._totalsize
@@ -49,8 +191,16 @@ class Snapshot(object):
         return '%s allocated, in %i blocks' % (fmt_size(self.total_size()), 
                                                self._num_usage)
 
+    def diff_from(self, old):
+        '''Get the Diff from an older snapshot to this one, reusing it if it
+        has been computed before (snapshots don't change once taken)'''
+        d = self._diff_cache.get(old)
+        if d is None:
+            d = self._diff_cache[old] = Diff(old, self)
+        return d
+
     def size_by_address(self, address):
-        return self._chunk_by_address[address].size
+        return self._sizes[self._index_of(address)]
 
 class History(object):
     '''History of snapshots of the state of the heap'''
@@ -58,7 +208,8 @@ class History(object):
         self.snapshots = []
 
     def add(self, name):
-        s = Snapshot.current(name)
+        prev = self.snapshots[-1] if self.snapshots else None
+        s = Snapshot.current(name, prev)
         self.snapshots.append(s)
         return s
 
@@ -68,8 +219,13 @@ class Diff(object):
         self.old = old
         self.new = new
 
-        self.new_minus_old = self.new._all_usage - self.old._all_usage
-        self.old_minus_new = self.old._all_usage - self.new._all_usage
+        # Compare by address, rather than building whole Usage instances:
+        new_addrs = set(self.new._starts)
+        old_addrs = set(self.old._starts)
+        self.new_minus_old = [self.new.usage_by_address(addr)
+                              for addr in new_addrs - old_addrs]
+        self.old_minus_new = [self.old.usage_by_address(addr)
+                              for addr in old_addrs - new_addrs]
 
     def stats(self):
         size_change = self.new.total_size() - self.old.total_size()
@@ -80,23 +236,31 @@ class Diff(object):
                                       fmt_size(count_change))
         
     def as_changes(self):
-        result = self.chunk_report('Free-d blocks', self.old, self.old_minus_new)
-        result += self.chunk_report('New blocks', self.new, self.new_minus_old)
         # FIXME: add changed chunks
-        return result
+        return ''.join([
+            self.chunk_report('Free-d blocks', self.old, self.old_minus_new),
+            self.chunk_report('New blocks', self.new, self.new_minus_old)])
 
     def chunk_report(self, title, snapshot, set_of_usage):
-        result = '%s:\n' % title
+        parts = ['%s:\n' % title]
         if len(set_of_usage) == 0:
-            result += '  (none)\n'
-            return result
-        for usage in sorted(set_of_usage,
-                            lambda u1, u2: cmp(u1.start, u2.start)):
-            result += ('  %s -> %s %8i bytes %20s |%s\n'
-                       % (fmt_addr(usage.start),
-                          fmt_addr(usage.start + usage.size-1),
-                          usage.size, usage.category, usage.hd))
-        return result
+            parts.append('  (none)\n')
+            return ''.join(parts)
+        # Local aliases, to avoid repeated global lookups within the loop:
+        _fmt_addr = fmt_addr
+        append = parts.append
+        for usage in sorted(set_of_usage, key=attrgetter('start')):
+            start = usage.start
+            size = usage.size
+            # This reads the memory as it is now, rather than as it was when
+            # the snapshot was taken; a freed block may no longer be mapped:
+            try:
+                usage.ensure_hexdump()
+            except RuntimeError:
+                usage.hd = ''
+            append(_ROW % (_fmt_addr(start), _fmt_addr(start + size - 1),
+                           size, usage.category, usage.hd))
+        return ''.join(parts)
     
 history = History()
 
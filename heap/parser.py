@@ -28,7 +28,7 @@ import ply.lex as lex
 
 reserved = ['AND', 'OR', 'NOT']
 tokens = [
-    'ID','LITERAL_NUMBER', 'LITERAL_STRING',
+    'ID','LITERAL_HEX', 'LITERAL_DEC', 'LITERAL_STRING',
     'LPAREN','RPAREN',
     'COMPARISON'
     ] + reserved
@@ -49,15 +49,18 @@ def t_COMPARISON(t):
     r'<=|<|==|=|!=|>=|>'
     return t
 
-def t_LITERAL_NUMBER(t):
-    r'(0x[0-9a-fA-F]+|\d+)'
-    try:
-        if t.value.startswith('0x'):
-            t.value = int(t.value, 16)
-        else:
-            t.value = int(t.value)
-    except ValueError:
-        raise ParserError(t.value)
+# Hexadecimal and decimal literals are separate tokens, so that each handler
+# knows which base to parse with (the regexes guarantee the digits are valid).
+# The hexadecimal rule must come first, so that the "0" of "0x" isn't taken
+# as a decimal literal:
+def t_LITERAL_HEX(t):
+    r'0x[0-9a-fA-F]+'
+    t.value = int(t.value, 16)
+    return t
+
+def t_LITERAL_DEC(t):
+    r'\d+'
+    t.value = int(t.value)
     return t
 
 def t_LITERAL_STRING(t):
@@ -97,7 +100,8 @@ from heap.query import Constant, And, Or, Not, GetAttr, \
 
 
 def p_expression_number(t):
-    'expression : LITERAL_NUMBER'
+    '''expression : LITERAL_HEX
+                  | LITERAL_DEC'''
     t[0] = Constant(t[1])
 
 def p_expression_string(t):
@@ -115,19 +119,47 @@ def p_comparison(t):
                 '>'  : Comparison__gt__ }
     cls = classes[t[2]]
 
-    t[0] = cls(t[1], t[3])
+    lhs, rhs = t[1], t[3]
+    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
+        # Fold comparisons between literals:
+        try:
+            t[0] = Constant(cls.cmp_(lhs.value, rhs.value))
+            return
+        except TypeError:
+            # e.g. 42 < "foo"; leave it to be evaluated (and fail) later
+            pass
+    t[0] = cls(lhs, rhs)
+
+# Where one side of a boolean operator is a literal, the result is known (or
+# is just the other side) without evaluating anything per-Usage:
 
 def p_and(t):
     'expression : expression AND expression'
-    t[0] = And(t[1], t[3])
+    lhs, rhs = t[1], t[3]
+    if isinstance(lhs, Constant):
+        t[0] = rhs if lhs.value else lhs
+    elif isinstance(rhs, Constant):
+        t[0] = lhs if rhs.value else rhs
+    else:
+        t[0] = And(lhs, rhs)
 
 def p_or(t):
     'expression : expression OR expression'
-    t[0] = Or(t[1], t[3])
+    lhs, rhs = t[1], t[3]
+    if isinstance(lhs, Constant):
+        t[0] = lhs if lhs.value else rhs
+    elif isinstance(rhs, Constant):
+        t[0] = rhs if rhs.value else lhs
+    else:
+        t[0] = Or(lhs, rhs)
 
 def p_not(t):
     'expression : NOT expression'
-    t[0] = Not(t[2])
+    inner = t[2]
+    if isinstance(inner, Constant):
+        t[0] = Constant(not inner.value)
+    else:
+        t[0] = Not(inner)
 
 def p_expression_group(t):
     'expression : LPAREN expression RPAREN'
@@ -177,12 +209,20 @@ def p_error(t):
 ############################################################################
 # Interface:
 ############################################################################
+from functools import lru_cache
+
+# Build the LALR tables once, rather than on every query (without writing
+# them out to disk; see ticket #12):
+parser = yacc.yacc(debug=0, write_tables=0)
 
-# Entry point:
+# Entry point.  Users tend to repeat the same handful of queries, and the
+# resulting expression trees are never modified, so reuse them:
+@lru_cache(maxsize=256)
 def parse_query(s):
     #try:
-    parser = yacc.yacc(debug=0, write_tables=0)
-    return parser.parse(s)#, debug=1)
+    # Use a fresh copy of the lexer, so that its state doesn't carry over
+    # from one query to the next:
+    return parser.parse(s, lexer=lexer.clone())#, debug=1)
     #except ParserError, e:
     #    print 'foo', e
 
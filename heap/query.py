@@ -14,12 +14,27 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import operator
 import sys
 
+# (Names within heap are looked up at call time, as some of them, e.g.
+# fmt_addr, only exist when running inside gdb)
+import heap
+
 class Expression(object):
     def eval_(self, u):
         raise NotImplementedError
 
+    def compile_(self):
+        '''Get a function taking a Usage and giving the same result as
+        eval_, but without walking the expression tree on every call'''
+        return self.eval_
+
+    def cost_(self):
+        '''Rough relative cost of evaluating this expression, so that the
+        cheaper side of an "and"/"or" can be tried first'''
+        return 1
+
     def __eq__(self, other):
         return (self.__class__ == other.__class__
                 and self.__dict__ == other.__dict__)
@@ -34,25 +49,74 @@ class Constant(Expression):
     def eval_(self, u):
         return self.value
 
+    def compile_(self):
+        value = self.value
+        return lambda u: value
+
+    def cost_(self):
+        return 0
+
 class GetAttr(Expression):
+    # Attributes of the Usage's Category, rather than of the Usage itself:
+    CATEGORY_ATTRS = ('domain', 'kind', 'detail')
+
     def __init__(self, attrname):
         self.attrname = attrname
+        # Build the lookup once, as a (C-implemented) attrgetter:
+        if attrname in self.CATEGORY_ATTRS:
+            self._getter = operator.attrgetter('category.' + attrname)
+        elif attrname == 'addr':
+            # "addr" is a synonym for the start address:
+            self._getter = operator.attrgetter('start')
+        else:
+            self._getter = operator.attrgetter(attrname)
 
     def __repr__(self):
         return 'GetAttr(%r)' % (self.attrname,)
 
+    def __eq__(self, other):
+        # (attrgetter instances only compare equal to themselves)
+        return (self.__class__ == other.__class__
+                and self.attrname == other.attrname)
+
     def eval_(self, u):
-        if self.attrname in ('domain', 'kind', 'detail'):
+        if self.attrname in self.CATEGORY_ATTRS:
             if u.category == None:
                 u.ensure_category()
-            return getattr(u.category, self.attrname)
-        return getattr(u, self.attrname)
+        return self._getter(u)
+
+    def compile_(self):
+        getter = self._getter
+        if self.attrname in self.CATEGORY_ATTRS:
+            def get_category_attr(u):
+                if u.category == None:
+                    u.ensure_category()
+                return getter(u)
+            return get_category_attr
+        return getter
+
+    def cost_(self):
+        # Category attributes may require the block to be categorized:
+        if self.attrname in self.CATEGORY_ATTRS:
+            return 10
+        return 1
 
 class BinaryOp(Expression):
     def __init__(self, lhs, rhs):
         self.lhs = lhs
         self.rhs = rhs
 
+    def cost_(self):
+        return self.lhs.cost_() + self.rhs.cost_()
+
+    def _cheapest_first(self):
+        # The operands are free of side effects (beyond caching a Usage's
+        # category), so it's safe to reorder them:
+        lhs, rhs = self.lhs, self.rhs
+        if rhs.cost_() < lhs.cost_():
+            lhs, rhs = rhs, lhs
+        return lhs.compile_(), rhs.compile_()
+
 class Comparison(BinaryOp):
     def __init__(self, lhs, rhs):
         BinaryOp.__init__(self, lhs, rhs)
@@ -65,32 +129,35 @@ class Comparison(BinaryOp):
         rhs_val = self.rhs.eval_(u)
         return self.cmp_(lhs_val, rhs_val)
 
+    def compile_(self):
+        lhs = self.lhs.compile_()
+        rhs = self.rhs.compile_()
+        cmp_ = self.cmp_
+        return lambda u: cmp_(lhs(u), rhs(u))
+
     def cmp_(self, lhs, rhs):
         raise NotImplementedError
 
+# The comparison functions from the operator module take the place of
+# methods here, to avoid an extra Python-level call per comparison:
+
 class Comparison__le__(Comparison):
-    def cmp_(self, lhs, rhs):
-        return lhs <= rhs
+    cmp_ = staticmethod(operator.le)
 
 class Comparison__lt__(Comparison):
-    def cmp_(self, lhs, rhs):
-        return lhs <  rhs
+    cmp_ = staticmethod(operator.lt)
 
 class Comparison__eq__(Comparison):
-    def cmp_(self, lhs, rhs):
-        return lhs == rhs
+    cmp_ = staticmethod(operator.eq)
 
 class Comparison__ne__(Comparison):
-    def cmp_(self, lhs, rhs):
-        return lhs != rhs
+    cmp_ = staticmethod(operator.ne)
 
 class Comparison__ge__(Comparison):
-    def cmp_(self, lhs, rhs):
-        return lhs >= rhs
+    cmp_ = staticmethod(operator.ge)
 
 class Comparison__gt__(Comparison):
-    def cmp_(self, lhs, rhs):
-        return lhs >  rhs
+    cmp_ = staticmethod(operator.gt)
 
 
 class And(BinaryOp):
@@ -103,6 +170,10 @@ class And(BinaryOp):
             return False
         return self.rhs.eval_(u)
 
+    def compile_(self):
+        lhs, rhs = self._cheapest_first()
+        return lambda u: lhs(u) and rhs(u)
+
 class Or(BinaryOp):
     def __repr__(self):
         return 'Or(%r, %r)' % (self.lhs, self.rhs)
@@ -113,6 +184,10 @@ class Or(BinaryOp):
             return True
         return self.rhs.eval_(u)
 
+    def compile_(self):
+        lhs, rhs = self._cheapest_first()
+        return lambda u: lhs(u) or rhs(u)
+
 class Not(Expression):
     def __init__(self, inner):
         self.inner = inner
@@ -120,6 +195,11 @@ class Not(Expression):
         return 'Not(%r)' % (self.inner, )
     def eval_(self, u):
         return not self.inner.eval_(u)
+    def compile_(self):
+        inner = self.inner.compile_()
+        return lambda u: not inner(u)
+    def cost_(self):
+        return self.inner.cost_()
 
 
 
@@ -135,25 +215,26 @@ class Query(object):
         self.filter_ = filter_
 
     def __iter__(self):
-        from heap import iter_usage_with_progress, lazily_get_usage_list
+        # Turn the expression tree into a function once, up-front, rather than
+        # walking the tree for every Usage:
+        predicate = self.filter_.compile_()
 
+        # (filter() drives the loop from C, only handing back the matches)
         if True:
             # 2-pass, but the expensive first pass may be cached
-            usage_list = lazily_get_usage_list()
-            for u in usage_list:
-                if self.filter_.eval_(u):
-                    yield u
+            usage_list = heap.lazily_get_usage_list()
+            return filter(predicate, usage_list)
         else:
             # 1-pass:
             # This may miss blocks that are only categorized w.r.t. to other
             # blocks:
-            for u in iter_usage_with_progress():
-                if self.filter_.eval_(u):
-                    yield u
+            return filter(predicate, heap.iter_usage_with_progress())
 
 def do_query(args):
-    from heap import fmt_addr, Table
+    # (heap.parser imports this module, so import it here rather than at the
+    # top):
     from heap.parser import parse_query
+    fmt_addr = heap.fmt_addr
 
     if args == '':
         # if no query supplied, select everything:
@@ -186,7 +267,7 @@ def do_query(args):
                       None),
                ]
 
-    t = Table([col.name for col in columns])
+    t = heap.Table([col.name for col in columns])
 
     for u in Query(filter_):
         u.ensure_hexdump()
@@ -25,16 +25,15 @@ from subprocess import Popen, PIPE, call as subprocess_call
 import sys
 import unittest
 import random
-from test.test_support import run_unittest, findfile
 
-if sys.maxint == 0x7fffffff:
+if sys.maxsize == 0x7fffffff:
     _32bit = True
 else:
     _32bit = False
 
 try:
     gdb_version, _ = Popen(["gdb", "--version"],
-                           stdout=PIPE).communicate()
+                           stdout=PIPE, universal_newlines=True).communicate()
 except OSError:
     # This is what "no gdb" looks like.  There may, however, be other
     # errors that manifest this way too.
@@ -45,8 +44,8 @@ if int(gdb_version_number.group(1)) < 7:
                             " Saw:\n" + gdb_version)
 
 # Verify that "gdb" was built with the embedded python support enabled:
-cmd = "--eval-command=python import sys; print sys.version_info"
-p = Popen(["gdb", "--batch", cmd], stdout=PIPE)
+cmd = "--eval-command=python import sys; print(sys.version_info)"
+p = Popen(["gdb", "--batch", cmd], stdout=PIPE, universal_newlines=True)
 gdbpy_version, _ = p.communicate()
 if gdbpy_version == '':
     raise unittest.SkipTest("gdb not built with embedded python support")
@@ -157,7 +156,8 @@ class DebuggerTests(unittest.TestCase):
 
         Returns its stdout, stderr
         """
-        out, err = Popen(args, stdout=PIPE, stderr=PIPE).communicate()
+        out, err = Popen(args, stdout=PIPE, stderr=PIPE,
+                         universal_newlines=True).communicate()
         return out, err
 
 
@@ -169,7 +169,8 @@ class DebuggerTests(unittest.TestCase):
             # It's either an absolute or relative path, and directly exists:
             return
 
-        p = Popen(['which', binary], stdout=PIPE, stderr=PIPE)
+        p = Popen(['which', binary], stdout=PIPE, stderr=PIPE,
+                  universal_newlines=True)
         out, err = p.communicate()
         if p.returncode == 0:
             # It's in the $PATH
@@ -201,8 +202,8 @@ class DebuggerTests(unittest.TestCase):
 
         # Ensure no unexpected error messages:
         if err != '':
-            print out
-            print err
+            print(out)
+            print(err)
             self.fail('stderr from gdb was non-empty: %r' % err)
 
         return out        
@@ -847,6 +848,28 @@ from heap.query import Constant, And, Or, Not, GetAttr, \
     Comparison__le__, Comparison__lt__, Comparison__eq__, \
     Comparison__ne__, Comparison__ge__, Comparison__gt__
 
+from heap.cplusplus import class_name_from_symbol, class_name_from_info_sym
+
+class VtableSymbolTests(unittest.TestCase):
+    def test_class_name_from_symbol(self):
+        self.assertEqual(class_name_from_symbol('0x401c70 <vtable for Foo+16>'),
+                         'Foo')
+        self.assertEqual(class_name_from_symbol('0x401c70 <vtable for Foo<Bar<int>>+16>'),
+                         'Foo<Bar<int>>')
+        self.assertEqual(class_name_from_symbol('0x401c70 <vtable for Foo<Bar<int>>>'),
+                         'Foo<Bar<int>>')
+        self.assertEqual(class_name_from_symbol('0x401c70 <typeinfo for Foo+8>'),
+                         None)
+        self.assertEqual(class_name_from_symbol('0x401c70'), None)
+
+    def test_class_name_from_info_sym(self):
+        self.assertEqual(class_name_from_info_sym('vtable for Foo + 16 in section .rodata of /tmp/a.out'),
+                         'Foo')
+        self.assertEqual(class_name_from_info_sym('vtable for Foo<Bar<int> > + 16 in section .rodata of /tmp/a.out'),
+                         'Foo<Bar<int> >')
+        self.assertEqual(class_name_from_info_sym('No symbol matches (void *)0x401c70.'),
+                         None)
+
 class QueryParsingTests(unittest.TestCase):
     def assertParsesTo(self, s, result):
         self.assertEquals(parse_query(s), result)
@@ -877,6 +900,84 @@ class QueryParsingTests(unittest.TestCase):
         #self.assertParsesTo('size == (256 * 1024)+8',
         #                    Comparison('size', '==', 1024L))
 
+    def test_constant_folding(self):
+        # Comparisons between literals are folded:
+        self.assertParsesTo('1 < 2', Constant(True))
+        self.assertParsesTo('"str" == "int"', Constant(False))
+
+        # ...but not those that can't be evaluated:
+        self.assertParsesTo('42 < "foo"',
+                            Comparison__lt__(Constant(42), Constant('foo')))
+
+        # "and"/"or" with a literal on either side collapse:
+        self.assertParsesTo('1 < 2 and size > 3',
+                            Comparison__gt__(GetAttr('size'), Constant(3)))
+        self.assertParsesTo('size > 3 and 0', Constant(0))
+        self.assertParsesTo('0 or size > 3',
+                            Comparison__gt__(GetAttr('size'), Constant(3)))
+        self.assertParsesTo('size > 3 or 1', Constant(1))
+
+        # "not" of a literal:
+        self.assertParsesTo('not 1', Constant(False))
+        self.assertParsesTo('not (1 > 2) and size > 3',
+                            Comparison__gt__(GetAttr('size'), Constant(3)))
+
+    def test_folding_preserves_results(self):
+        from heap import Usage
+        usages = [Usage(0x1000, 2), Usage(0x2000, 8)]
+        for folded, unfolded in [('1 < 2 and size > 3',
+                                  And(Comparison__lt__(Constant(1), Constant(2)),
+                                      Comparison__gt__(GetAttr('size'), Constant(3)))),
+                                 ('1 > 2 or size > 3',
+                                  Or(Comparison__gt__(Constant(1), Constant(2)),
+                                     Comparison__gt__(GetAttr('size'), Constant(3))))]:
+            expr = parse_query(folded)
+            self.assertNotEqual(expr, unfolded)
+            for u in usages:
+                self.assertEqual(bool(expr.eval_(u)), bool(unfolded.eval_(u)))
+
+
+class QueryEvaluationTests(unittest.TestCase):
+    def setUp(self):
+        from heap import Usage
+        self.usages = [Usage(0x1000, 16), Usage(0x2000, 64), Usage(0x3000, 1024)]
+
+    def select(self, expr):
+        compiled = expr.compile_()
+        return ([u for u in self.usages if compiled(u)],
+                [u for u in self.usages if expr.eval_(u)])
+
+    def test_addr(self):
+        # "addr" is a synonym for "start":
+        self.assertEqual(GetAttr('addr'), GetAttr('addr'))
+        self.assertNotEqual(GetAttr('addr'), GetAttr('start'))
+        by_addr = self.select(parse_query('addr == 0x2000'))
+        by_start = self.select(parse_query('start == 0x2000'))
+        self.assertEqual(by_addr, by_start)
+        self.assertEqual(by_addr, ([self.usages[1]], [self.usages[1]]))
+
+    def test_compile_matches_eval(self):
+        size = GetAttr('size')
+        start = GetAttr('start')
+        small = Comparison__lt__(size, Constant(64))
+        low = Comparison__le__(start, Constant(0x2000))
+        # (expression, indices of the expected usages)
+        table = [(Comparison__le__(size, Constant(64)), [0, 1]),
+                 (small, [0]),
+                 (Comparison__eq__(size, Constant(64)), [1]),
+                 (Comparison__ne__(size, Constant(64)), [0, 2]),
+                 (Comparison__ge__(size, Constant(64)), [1, 2]),
+                 (Comparison__gt__(size, Constant(64)), [2]),
+                 (And(low, Not(small)), [1]),
+                 (Or(small, Comparison__gt__(start, Constant(0x2000))), [0, 2]),
+                 (Not(low), [2]),
+                 (Constant(True), [0, 1, 2]),
+                 (Constant(False), []),
+                 ]
+        for expr, expected in table:
+            expected = [self.usages[i] for i in expected]
+            self.assertEqual(self.select(expr), (expected, expected), expr)
+
 
 if __name__ == "__main__":
     unittest.main()